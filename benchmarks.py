@@ -0,0 +1,205 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2011-2014, Hui Liu
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------
+
+"""Timings of the EMDY GUI readers and builders.
+
+Not part of the plugin.  Run it with the PyMOL Python, EMDY installed and
+emdy_gui.py importable, e.g.
+
+    pymol -cq benchmarks.py -- pdb 1abc.pdb
+    pymol -cq benchmarks.py -- cif 1abc.pdb 1abc.cif
+    pymol -cq benchmarks.py -- selection 1abc.pdb
+    pymol -cq benchmarks.py -- build 1abc.pdb top.rtf par.prm
+    pymol -cq benchmarks.py -- coords 1abc.pdb top.rtf par.prm
+    pymol -cq benchmarks.py -- vsites 100000
+"""
+
+import os
+import sys
+import copy
+import time
+import tempfile
+
+import numpy as np
+from pymol import cmd
+
+import emdy_gui as gui
+
+
+def best_time(func, repeat=3):
+    """Best of repeat wall-clock timings of func() and its last result."""
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        result = func()
+        t = time.time() - t0
+        best = t if best is None else min(best, t)
+    return best, result
+
+
+def benchmark_pdb_read(fname, repeat=3):
+    """Print the best of repeat timings of PdbFile and read_pdb."""
+    for label, func in (('PdbFile', lambda: gui.PdbFile(fname).read()),
+                        ('read_pdb', lambda: gui.read_pdb(fname))):
+        print('%-10s %8.3f s' % (label, best_time(func, repeat)[0]))
+
+
+def benchmark_cif_read(pdbfile, ciffile, repeat=3):
+    """Print the best of repeat timings of read_pdb and read_cif on
+    the same structure, with their throughput."""
+    for label, fname, func in (('read_pdb', pdbfile, gui.read_pdb),
+                               ('read_cif', ciffile, gui.read_cif)):
+        best, cols = best_time(lambda: func(fname), repeat)
+        print('%-10s %8.3f s %10.0f atoms/s %8.1f MB/s' %
+              (label, best, len(cols) / best,
+               os.path.getsize(fname) / best / 1e6))
+
+
+def benchmark_selection_read(selection, fname, repeat=3):
+    """Time reading a selection against cmd.get_model and reading
+    the same atoms from a PDB file."""
+    cmd.save(fname, selection)
+    for label, func in (('get_model', lambda: cmd.get_model(selection)),
+                        ('selection',
+                         lambda: gui.read_selection(selection)),
+                        ('read_pdb', lambda: gui.read_pdb(fname))):
+        print('%-10s %8.3f s' % (label, best_time(func, repeat)[0]))
+
+
+def benchmark_parallel_build(mod, top, prm):
+    """Time serial and per-segment builds and compare the results."""
+    t0 = time.time()
+    a = gui.add_atoms(mod, top, prm)
+    t1 = time.time()
+    b = gui.add_atoms(mod, top, prm, parallel=True)
+    t2 = time.time()
+    same = (len(a.atoms) == len(b.atoms) and
+            [x.name for x in a.atoms] == [x.name for x in b.atoms] and
+            np.allclose(np.asarray(a.coords), np.asarray(b.coords)) and
+            all(np.array_equal(gui.get_terms(a, attr, w),
+                               gui.get_terms(b, attr, w))
+                for attr, w in gui.TERMS))
+    print('serial    %8.3f s' % (t1 - t0))
+    print('parallel  %8.3f s' % (t2 - t1))
+    print('identical: %s' % same)
+
+
+def benchmark_coord_builders(mod, top, prm):
+    """Time IC placement against CharmmCoordBuilder on the same
+    built model and print the largest deviation."""
+    built = gui.build_topology(mod, top)
+    a = copy.deepcopy(built)
+    t0 = time.time()
+    gui.place_by_ic(a, top)
+    t1 = time.time()
+    b = gui.CharmmCoordBuilder(copy.deepcopy(built), prm).complete_coords()
+    t2 = time.time()
+    xa = np.asarray(a.coords)
+    xb = np.asarray(b.coords)
+    placed = ~np.isfinite(np.asarray(built.coords)).all(axis=1)
+    placed &= np.isfinite(xa).all(axis=1)
+    dev = np.sqrt(((xa - xb)[placed]**2).sum(axis=1))
+    print('IC placement        %8.3f s' % (t1 - t0))
+    print('CharmmCoordBuilder  %8.3f s' % (t2 - t1))
+    print('%d atoms, max deviation %.4f A' %
+          (placed.sum(), dev.max() if len(dev) else 0.0))
+
+
+def benchmark_virtual_sites(nwaters=100000):
+    """Time TIP4P and TIP5P site placement on a box of nwaters
+    (3 x nwaters atoms) against placing them one water at a time."""
+    cols = gui.ColumnarModel(3 * nwaters)
+    cols.names[:] = cols.strings.encode(['OH2', 'H1', 'H2'] * nwaters)
+    cols.resnames[:] = cols.strings.encode(['TIP3'])[0]
+    cols.resids[:] = np.repeat(np.arange(1, nwaters + 1), 3)
+    side = np.ceil(nwaters ** (1.0 / 3))
+    grid = np.indices((int(side),) * 3).reshape(3, -1).T[:nwaters]
+    cols.coords[:] = (np.repeat(grid * 3.1, 3, axis=0) +
+                      np.tile([[0, 0, 0], [0.9572, 0, 0],
+                               [-0.24, 0.9266, 0]], (nwaters, 1)))
+    for water in sorted(gui.WATER_SITES):
+        t0 = time.time()
+        sites = gui.water_sites(cols, water)
+        xyz = sites.positions(cols.coords)
+        t1 = time.time()
+        slow = []
+        for o, h1, h2 in sites.frames.tolist():
+            r1 = cols.coords[h1] - cols.coords[o]
+            r2 = cols.coords[h2] - cols.coords[o]
+            for a, b, c in zip(sites.a, sites.b, sites.c):
+                slow.append(cols.coords[o] + a * r1 + b * r2 +
+                            c * np.cross(r1, r2))
+        t2 = time.time()
+        err = np.abs(np.array(slow) - xyz.reshape(-1, 3)).max()
+        print('%s: %d sites, vectorized %.3f s, per water %.3f s, '
+              'max difference %.1e' % (water, len(sites), t1 - t0,
+                                       t2 - t1, err))
+
+
+def main(args):
+    if not gui._HAS_LIB:
+        print('EMDY and NumPy are needed for the benchmarks')
+        return 1
+    if not args:
+        print(__doc__)
+        return 1
+    name, args = args[0], args[1:]
+    if name == 'pdb':
+        benchmark_pdb_read(*args)
+    elif name == 'cif':
+        benchmark_cif_read(*args)
+    elif name == 'selection':
+        cmd.load(args[0], 'bench')
+        fd, path = tempfile.mkstemp(suffix='.pdb')
+        os.close(fd)
+        try:
+            benchmark_selection_read('bench', path)
+        finally:
+            os.remove(path)
+    elif name in ('build', 'coords'):
+        pdb, topfile, prmfile = args
+        mod = gui.read_pdb(pdb)
+        top = gui.read_charmm_top(topfile)
+        prm = gui.read_charmm_prm(prmfile)
+        if name == 'build':
+            benchmark_parallel_build(mod, top, prm)
+        else:
+            benchmark_coord_builders(mod, top, prm)
+    elif name == 'vsites':
+        benchmark_virtual_sites(*[int(a) for a in args])
+    else:
+        print(__doc__)
+        return 1
+    return 0
+
+
+if __name__ in ('__main__', 'pymol'):
+    sys.exit(main(sys.argv[1:]))
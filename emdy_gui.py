@@ -30,7 +30,28 @@
 # ----------------------------------------------------------------------
 
 import os
+import re
 import sys
+import copy
+import random
+import atexit
+import bz2
+import gzip
+import hashlib
+import mmap
+import time
+import zlib
+import tempfile
+import threading
+import traceback
+import multiprocessing
+import shutil
+import urllib2
+import Queue
+from itertools import takewhile
+from multiprocessing.pool import ThreadPool
+from contextlib import contextmanager
+from functools import partial
 from cStringIO import StringIO
 from Tkinter import *
 import tkMessageBox
@@ -41,6 +62,19 @@ import Pmw
 from pymol import cmd, util
 from pymol.cgo import *
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
 try:
     from emdy.io import *
     from emdy.io.charmmtopfile import CharmmTopFile
@@ -48,6 +82,7 @@ try:
     from emdy.setup.build import CharmmTopBuilder, CharmmCoordBuilder
     from emdy.setup.solvate import Solvater
     from emdy.setup.ionize import Ionizer
+    import numpy as np
 except ImportError:
     _HAS_LIB = 0
 else:
@@ -90,6 +125,55 @@ IONS = {
     'Cl-': 'CLA'
     }
 
+ION_CHARGES = {'SOD': 1, 'POT': 1, 'MG': 2, 'CAL': 2, 'ZN2': 2, 'CLA': -1}
+
+WATERS = ('HOH', 'WAT', 'SOL', 'TIP3', 'TIP4', 'TIP5', 'SPC', 'T3P', 'T4P',
+          'T5P')
+
+# water models with massless sites: the (O, H) charges and, per site, its
+# name, charge and a, b, c of O + a * OH1 + b * OH2 + c * (OH1 x OH2)
+WATER_SITES = {
+    'TIP4P': ((0.0, 0.52),
+              (('OM', -1.04, 0.128012065, 0.128012065, 0.0),)),
+    'TIP5P': ((0.0, 0.241),
+              (('LP1', -0.241, -0.344908, -0.344908, -0.64437903),
+               ('LP2', -0.241, -0.344908, -0.344908, 0.64437903))),
+    }
+
+CIF_URL = 'https://files.rcsb.org/download/%s.cif.gz'
+
+# van der Waals radii (A) by element, keyed on the first letter of the name
+VDW_RADII = {'H': 1.1, 'C': 1.7, 'N': 1.55, 'O': 1.52, 'S': 1.8, 'P': 1.8}
+
+AVOGADRO = 6.02214076e23
+
+# solvent atom counts above which solvent is drawn as small spheres or hidden
+SOLVENT_SPHERES = 20000
+SOLVENT_HIDDEN = 200000
+
+AMINO_ACIDS = ('ALA,ARG,ASN,ASP,CYS,GLN,GLU,GLY,HSD,HSE,HSP,ILE,LEU,LYS,'
+               'MET,PHE,PRO,SER,THR,TRP,TYR,VAL')
+
+# PDB to CHARMM names, in the layout of a rename rule file: residue
+# renames, then atom renames keyed on the (new) residue names or '*', and
+# atom renames applied to the last residue of each segment only
+DEFAULT_RULES = {
+    'residues': {'HIS': 'HSD', 'HID': 'HSD', 'HIE': 'HSE', 'HIP': 'HSP',
+                 'CYX': 'CYS', 'HOH': 'TIP3', 'WAT': 'TIP3', 'NA': 'SOD',
+                 'K': 'POT', 'CL': 'CLA', 'CA': 'CAL', 'ZN': 'ZN2'},
+    'atoms': {AMINO_ACIDS: {'H': 'HN'},
+              'ILE': {'CD1': 'CD'},
+              'SER': {'HG': 'HG1'},
+              'CYS': {'HG': 'HG1'},
+              'TIP3': {'O': 'OH2'},
+              'SOD': {'NA': 'SOD'},
+              'POT': {'K': 'POT'},
+              'CLA': {'CL': 'CLA'},
+              'CAL': {'CA': 'CAL'},
+              'ZN2': {'ZN': 'ZN'}},
+    'terminal': {AMINO_ACIDS: {'O': 'OT1', 'OXT': 'OT2'}},
+    }
+
 
 def __init__(self):
     """Register function for the plugin."""
@@ -128,6 +212,12 @@ class EmdyGui:
         self.mod = None
         self.top = None
         self.prm = None
+        self.conformers = None
+        self.ensemble = None
+        self.biomt = None
+        self.water = None
+        self.worker = None
+        self.remote = None
         self.pmobj = []
         self.original_stdout = sys.stdout
         self.create_widgets()
@@ -295,6 +385,35 @@ class EmdyGui:
                 text='Browse',
                 width=10)
 
+        frame = Frame(group.interior())
+        frame.pack(**frm_opt)
+
+        self.use_ensemble = IntVar()
+        self.use_ensemble.set(0)
+        Checkbutton(frame,
+                    text='Read all models and write one coordinate file each',
+                    variable=self.use_ensemble).pack(side='left', padx=10)
+
+        frame = Frame(group.interior())
+        frame.pack(**frm_opt)
+
+        self.use_pmsel = IntVar()
+        self.use_pmsel.set(0)
+        Checkbutton(frame,
+                    text='Read atoms from the PyMOL selection:',
+                    variable=self.use_pmsel).pack(side='left', padx=10)
+        self.pmsel = CleanableEntryField(frame, value='original')
+        self.pmsel.pack(side='left', fill='x', expand=1, padx=0, pady=5)
+
+        frame = Frame(group.interior())
+        frame.pack(**frm_opt)
+
+        self.use_assembly = IntVar()
+        self.use_assembly.set(0)
+        Checkbutton(frame,
+                    text='Generate the biological assembly from BIOMT records',
+                    variable=self.use_assembly).pack(side='left', padx=10)
+
         # "Output" group
         # **********
         group = Pmw.Group(page, tag_text='Output Files')
@@ -359,6 +478,33 @@ class EmdyGui:
                 menubutton_width=14)
         self.crdfmt.pack(side='right', anchor='w', padx=10, pady=5)
 
+        frame = Frame(group.interior())
+        frame.pack(**frm_opt)
+
+        self.use_hmr = IntVar()
+        self.use_hmr.set(0)
+        Checkbutton(frame,
+                    text='Repartition hydrogen masses to',
+                    variable=self.use_hmr).pack(side='left', padx=10)
+        self.hmass = CleanableEntryField(
+                frame,
+                labelpos='e',
+                entry_width=8,
+                validate={'validator': 'real', 'min': 0.5},
+                value=3.024,
+                label_text='amu')
+        self.hmass.pack(side='left', anchor='w', pady=5)
+
+        frame = Frame(group.interior())
+        frame.pack(**frm_opt)
+
+        self.use_pruned = IntVar()
+        self.use_pruned.set(0)
+        Checkbutton(frame,
+                    text='Write the parameters used next to the topology '
+                         '(NAMD psf)',
+                    variable=self.use_pruned).pack(side='left', padx=10)
+
     def create_prep_page(self):
         page = self.notebook.add('Preparation')
 
@@ -370,6 +516,7 @@ class EmdyGui:
         self.ign_ion = IntVar()
         self.autodisu = IntVar()
         self.userdisu = IntVar()
+        self.use_parallel = IntVar()
 
         self.use_defrule.set(1)
         self.use_userrule.set(0)
@@ -379,6 +526,7 @@ class EmdyGui:
         self.ign_ion.set(0)
         self.autodisu.set(0)
         self.userdisu.set(0)
+        self.use_parallel.set(0)
 
         grp_opt = {'fill': 'both', 'expand': 1, 'padx': 10, 'pady': 5}
         frm_opt = {'fill': 'both', 'expand': 1}
@@ -463,6 +611,14 @@ class EmdyGui:
                 state='disabled')
         self.opendisubtn.pack(**btn_opt)
 
+        # "Build"
+        # **********
+        group = Pmw.Group(page, tag_text='Build')
+        group.pack(**grp_opt)
+
+        Checkbutton(group.interior(), text='Build segments in parallel',
+                    variable=self.use_parallel).pack(**chk_opt)
+
     def toggle_state(self, w):
         if w['state'] == 'normal':
             w.configure(state='disabled')
@@ -516,6 +672,15 @@ class EmdyGui:
 
         Pmw.alignlabels([self.watmod, self.watseg])
 
+        self.use_cosolv = IntVar()
+        self.use_cosolv.set(0)
+        Checkbutton(igroup.interior(),
+                    text='Add cosolvents (PDB file and molarity, '
+                         'comma separated):',
+                    variable=self.use_cosolv).pack(anchor='w', padx=10)
+        self.cosolv = CleanableEntryField(igroup.interior())
+        self.cosolv.pack(fill='x', expand=1, padx=10, pady=5)
+
         # "Box Shape"
         # **********
         igroup = Pmw.Group(frame, tag_text='Box Shape')
@@ -537,6 +702,50 @@ class EmdyGui:
                         variable=self.boxshape,
                         value=val).pack(anchor='w', expand=1)
 
+        # "Display"
+        # **********
+        igroup = Pmw.Group(frame, tag_text='Display')
+        igroup.pack(**grp_opt)
+
+        self.soldisp = Pmw.OptionMenu(
+                igroup.interior(),
+                labelpos='w',
+                label_text='Solvent:',
+                items=('auto', 'lines', 'spheres', 'hidden'),
+                command=lambda value: self.apply_display(),
+                menubutton_width=12)
+        self.soldisp.pack(anchor='w', expand=1, padx=10, pady=5)
+
+        self.use_shell = IntVar()
+        self.use_shell.set(0)
+
+        w = Frame(igroup.interior())
+        w.pack(anchor='w', expand=1, padx=10)
+
+        Checkbutton(w, text='Show solvent within',
+                    variable=self.use_shell,
+                    command=self.apply_display).pack(side='left')
+
+        self.shellcut = CleanableEntryField(
+                w,
+                labelpos='e',
+                entry_width=6,
+                validate={'validator': 'real', 'min': 0.0},
+                value=5.0,
+                label_text=u'\xc5',
+                command=self.apply_display)
+        self.shellcut.pack(side='left', pady=5)
+
+        self.shellsel = CleanableEntryField(
+                igroup.interior(),
+                labelpos='w',
+                value='polymer',
+                label_text='of selection:',
+                command=self.apply_display)
+        self.shellsel.pack(anchor='w', expand=1, padx=10, pady=5)
+
+        Pmw.alignlabels([self.soldisp, self.shellsel])
+
         # "Box Parameters"
         # **********
         igroup = Pmw.Group(page, tag_text='Box Parameters')
@@ -858,6 +1067,12 @@ class EmdyGui:
                 text='Calculate the total charge')
         self.calcqbtn.pack(fill='both', expand=0, padx=10, pady=5)
 
+        self.estionbtn = Button(
+                igroup.interior(),
+                command=self.on_estion_clicked,
+                text='Estimate the ion numbers')
+        self.estionbtn.pack(fill='both', expand=0, padx=10, pady=5)
+
         Checkbutton(igroup.interior(),
                     text='automatically neutralize',
                     variable=self.do_neutral,
@@ -919,15 +1134,53 @@ class EmdyGui:
                 label_text='Salt Concentration (mol/L):')
         self.salcon.pack(**ent_opt)
 
-        Pmw.alignlabels([self.ionion, self.ionsol, self.salcon])
+        self.ionseed = CleanableEntryField(
+                igroup.interior(),
+                labelpos='w',
+                entry_width=5,
+                validate={'validator': 'integer', 'min': 0},
+                label_text='Random Seed:')
+        self.ionseed.pack(**ent_opt)
+
+        self.iontrials = Pmw.Counter(
+                igroup.interior(),
+                labelpos='w',
+                label_text='Placement Trials:',
+                entry_width=5,
+                entryfield_value=1,
+                datatype={'counter': 'integer'},
+                entryfield_validate={'validator': 'integer', 'min': '1'})
+        self.iontrials.pack(**ent_opt)
+
+        Pmw.alignlabels([self.ionion, self.ionsol, self.salcon, self.ionseed,
+                         self.iontrials])
 
     def on_calcq_clicked(self):
         if not _HAS_LIB or self.mod is None:
             return
-        q = fsum([atom.charge for atom in self.mod.atoms])
+        q = as_columns(self.mod).total_charge()
         tkMessageBox.showinfo('INFO', 'Total charge is %+f e'%q,
                               parent=self.parent)
 
+    def on_estion_clicked(self):
+        if not _HAS_LIB or self.mod is None:
+            return
+        cols = as_columns(self.mod)
+        catmod = IONS[self.catmod.getvalue()]
+        animod = IONS[self.animod.getvalue()]
+        if self.do_neutral.get():
+            ncat, nani, vol = estimate_ions(cols, catmod, animod,
+                                            float(self.salcon.getvalue()))
+        else:
+            ncat = int(self.catnum.getvalue())
+            nani = int(self.aninum.getvalue())
+            vol = solvent_volume(cols)
+        msg = ('Solvent volume is %.0f A^3\n%d %s and %d %s will be added' %
+               (vol, ncat, self.catmod.getvalue(), nani,
+                self.animod.getvalue()))
+        print(msg)
+        tkMessageBox.showinfo('INFO', msg, parent=self.parent)
+
     def toggle_nions_salcon(self):
         for w in self.catnum, self.aninum, self.salcon:
             self.toggle_state(w.component('entry'))
@@ -953,7 +1206,13 @@ class EmdyGui:
                 parent=self.parent)
             return 1
 
-        if not self.pdbloc.getvalue():
+        if self.use_pmsel.get():
+            if not self.pmsel.getvalue():
+                tkMessageBox.showerror('ERROR',
+                                       'Please specify a PyMOL selection',
+                                       parent=self.parent)
+                return 1
+        elif not self.pdbloc.getvalue():
             tkMessageBox.showerror('ERROR', 'Please specify a pdb file',
                                    parent=self.parent)
             return 1
@@ -968,11 +1227,121 @@ class EmdyGui:
                                    parent=self.parent)
             return 1
 
-        self.mod = PdbFile(self.pdbloc.getvalue()).read()
-        self.top = CharmmTopFile(self.ffloc.getvalue()).read()
-        self.prm = CharmmPrmFile(self.parloc.getvalue()).read()
+        maxmodels = None if self.use_ensemble.get() else 1
+        predicate = RecordFilter(self.ign_h.get(), self.ign_lig.get(),
+                                 self.ign_wat.get(), self.ign_ion.get())
+        jobs = [('top', read_charmm_top, self.ffloc.getvalue()),
+                ('prm', read_charmm_prm, self.parloc.getvalue())]
+        results = {}
+        if self.use_pmsel.get():
+            # PyMOL can only be driven from this process
+            t0 = time.time()
+            sel = self.pmsel.getvalue()
+            try:
+                results['mod'] = read_selection_models(sel, maxmodels,
+                                                       predicate)
+            except Exception as e:
+                print('Failed to read the selection: %s' % e)
+                tkMessageBox.showerror('ERROR',
+                                       'Failed to read "%s"' % sel,
+                                       parent=self.parent)
+                return 1
+            if not len(results['mod'][0]):
+                tkMessageBox.showerror('ERROR',
+                                       'No atoms in "%s"' % sel,
+                                       parent=self.parent)
+                return 1
+            print('Read selection %s in %.2f s' % (sel, time.time() - t0))
+        else:
+            jobs.append(('mod', partial(read_input_filtered,
+                                        maxmodels=maxmodels,
+                                        predicate=predicate),
+                         self.pdbloc.getvalue()))
+            if self.use_assembly.get() and not is_cif(self.pdbloc.getvalue()):
+                jobs.append(('biomt', read_biomt, self.pdbloc.getvalue()))
+        try:
+            for key, fname, result, t in parse_concurrently(jobs):
+                print('Read %s in %.2f s' % (fname, t))
+                if key == 'mod':
+                    result, predicate.removed = result
+                results[key] = result
+        except ParseError as e:
+            print(e.tb)
+            tkMessageBox.showerror('ERROR', 'Failed to read "%s"' % e.fname,
+                                   parent=self.parent)
+            return 1
+        if self.use_ensemble.get():
+            models = results['mod']
+            if len(set(len(m) for m in models)) != 1:
+                tkMessageBox.showerror(
+                    'ERROR', 'All models must contain the same atoms',
+                    parent=self.parent)
+                return 1
+            self.mod = models[0]
+            self.conformers = [m.coords for m in models]
+            print('Read %d models' % len(models))
+        else:
+            self.mod = results['mod'][0]
+            self.conformers = None
+        if predicate:
+            print('Ignored atoms: %s' % predicate.report())
+        self.biomt = results.get('biomt')
+        self.water = None
+        if self.use_assembly.get():
+            if self.biomt:
+                print('Biological assembly of %d copies' %
+                      sum(len(m) for c, m in self.biomt))
+            else:
+                print('No BIOMT records found, using the input as is')
+        self.ensemble = None
+        self.top = results['top']
+        self.prm = results['prm']
+        try:
+            self.rename_input()
+        except Exception as e:
+            print('Failed to apply the rename rules: %s' % e)
+            tkMessageBox.showerror('ERROR', 'Failed to apply the rename rules',
+                                   parent=self.parent)
+            return 1
+        self.run_preflight()
         return 0
 
+    def rename_input(self):
+        """Apply the rename rules chosen on the Preparation page.
+
+        Called once per input from load_input, as the rules need not be
+        idempotent.
+        """
+        rules = RenameRules()
+        if self.use_defrule.get():
+            rules.update(load_rules())
+        if self.use_userrule.get() and self.renloc.getvalue():
+            rules.update(load_rules(self.renloc.getvalue()))
+        cols = as_columns(self.mod)
+        if not len(rules) or cols.model is not None:
+            return
+        nres, nnames = apply_rules(cols, rules)
+        self.mod = cols
+        print('Renamed %d residue names and %d atom names' % (nres, nnames))
+
+    def run_preflight(self):
+        t0 = time.time()
+        patches = []
+        if self.autodisu.get() or self.userdisu.get():
+            patches.append('DISU')
+        problems = preflight(as_columns(self.mod), self.top, self.prm,
+                             patches)
+        for p in problems:
+            print(p)
+        print('Preflight: %d problems found in %.2f s' %
+              (len(problems), time.time() - t0))
+        if problems:
+            tkMessageBox.showwarning(
+                'WARNING',
+                '%d problems were found in the input, '
+                'see the console for the list' % len(problems),
+                parent=self.parent)
+
     def on_execute_button_clicked(self):
         if not _HAS_LIB:
             tkMessageBox.showerror(
@@ -987,12 +1356,29 @@ class EmdyGui:
                 if failed:
                     return
             try:
-                self.mod = add_atoms(self.mod, self.top, self.prm)
-            except Exception:
-                tkMessageBox.showerror(
-                    'ERROR',
-                    'Failed',
-                    parent=self.parent)
+                if self.conformers and len(self.conformers) > 1:
+                    mod, self.ensemble = add_atoms_ensemble(
+                            self.mod, self.conformers, self.top, self.prm)
+                    self.mod = as_columns(mod)
+                else:
+                    cutoff = 3.0
+                    if self.autodisu.get():
+                        cutoff = float(self.disucut.getvalue())
+                    mod = add_atoms(self.mod, self.top, self.prm,
+                                    self.use_parallel.get(), cutoff)
+                    biomt = self.biomt if self.use_assembly.get() else None
+                    if biomt:
+                        t0 = time.time()
+                        mod = replicate_model(mod, biomt)
+                        print('Replicated the assembly to %d atoms in '
+                              '%.2f s' % (len(mod.atoms), time.time() - t0))
+                    self.mod = as_columns(mod)
+                    if biomt:
+                        # the copies keep their chain ids, so the model
+                        # must not be expanded again
+                        self.biomt = None
+            except Exception as e:
+                self.show_stage_error('Preparation', e)
             else:
                 tkMessageBox.showinfo(
                     'INFO',
@@ -1004,17 +1390,19 @@ class EmdyGui:
                 failed = self.load_input()
                 if failed:
                     return
+            self.discard_ensemble()
             try:
-                self.mod = add_solvents(self.mod, self.watmod.getvalue(),
-                                        self.watseg.getvalue(),
-                                        self.boxshape.get(),
-                                        float(self.pad.getvalue()),
-                                        float(self.cut.getvalue()))
-            except Exception:
-                tkMessageBox.showerror(
-                    'ERROR',
-                    'Failed',
-                    parent=self.parent)
+                self.run_stage('add_solvents', self.watmod.getvalue(),
+                               self.watseg.getvalue(), self.boxshape.get(),
+                               float(self.pad.getvalue()),
+                               float(self.cut.getvalue()))
+                self.water = self.watmod.getvalue()
+                if self.use_cosolv.get():
+                    self.run_stage('add_cosolvents', self.top,
+                                   parse_cosolvents(self.cosolv.getvalue()),
+                                   float(self.cut.getvalue()))
+            except Exception as e:
+                self.show_stage_error('Solvation', e)
             else:
                 tkMessageBox.showinfo(
                     'INFO',
@@ -1027,28 +1415,43 @@ class EmdyGui:
                 if failed:
                     return
 
-            if self.do_neutral.get():
-                catnum = aninum = 0
-            else:
+            catmod = IONS[self.catmod.getvalue()]
+            animod = IONS[self.animod.getvalue()]
+            saltcon = float(self.salcon.getvalue())
+            if not self.do_neutral.get():
                 catnum = int(self.catnum.getvalue())
                 aninum = int(self.aninum.getvalue())
                 if catnum == aninum == 0:
                     return
 
-            catmod = IONS[self.catmod.getvalue()]
-            animod = IONS[self.animod.getvalue()]
-
+            self.discard_ensemble()
             try:
-                self.mod = add_ions(self.mod, catmod, catnum, animod, aninum,
-                                    float(self.salcon.getvalue()),
-                                    float(self.ionsol.getvalue()),
-                                    float(self.ionion.getvalue()), None,
-                                    self.ionseg.getvalue(), self.ionmeth.get())
-            except Exception:
-                tkMessageBox.showerror(
-                    'ERROR',
-                    'Failed',
-                    parent=self.parent)
+                cols = as_columns(self.mod)
+                if self.do_neutral.get():
+                    # the counts "Estimate" shows, so Ionizer adds no salt
+                    # of its own
+                    catnum, aninum, volume = estimate_ions(cols, catmod,
+                                                           animod, saltcon)
+                    saltcon = 0.0
+                else:
+                    volume = solvent_volume(cols)
+                print('Adding %d %s and %d %s' %
+                      (catnum, self.catmod.getvalue(), aninum,
+                       self.animod.getvalue()))
+                args = (catmod, catnum, animod, aninum, saltcon,
+                        float(self.ionsol.getvalue()),
+                        float(self.ionion.getvalue()), volume,
+                        self.ionseg.getvalue(), self.ionmeth.get())
+                if self.ionmeth.get() == 1:
+                    if not self.ionseed.getvalue():
+                        self.ionseed.setvalue(random.randint(0, 2**31 - 1))
+                    self.run_stage('add_ions_seeded',
+                                   int(self.ionseed.getvalue()),
+                                   int(self.iontrials.getvalue()), *args)
+                else:
+                    self.run_stage('add_ions', *args)
+            except Exception as e:
+                self.show_stage_error('Ionization', e)
             else:
                 tkMessageBox.showinfo(
                     'INFO',
@@ -1063,16 +1466,95 @@ class EmdyGui:
         # generate a tmp file for view
         objname = {'Preparation': 'modified', 'Solvation': 'solvated',
                    'Ionization': 'ionized'}[self.notebook.getcurselection()]
-        tmpfp = StringIO()
-        with PdbFile(tmpfp, 'w') as f:
-            f.write(self.mod)
-            for obj in self.pmobj:
-                cmd.delete(obj)
-            cmd.read_pdbstr(tmpfp.getvalue(), objname)
-            util.cbag()
-            self.pmobj = [objname]
-            if self.notebook.getcurselection() == 'Ionization':
-                cmd.show('spheres', 'segi %s'%self.ionseg.getvalue())
+        for obj in self.pmobj:
+            cmd.delete(obj)
+        view_pdb(self.mod, objname)
+        util.cbag()
+        self.pmobj = [objname]
+        self.apply_display()
+
+    def apply_display(self):
+        """Show the viewed system according to its size.
+
+        Solvent is drawn as lines, small spheres or not at all depending on
+        its atom count, the solute as sticks or lines and ions as spheres.
+        Only representations of selections change, nothing is reloaded.
+        """
+        if not self.pmobj:
+            return
+        obj = self.pmobj[0]
+        solvent = '(%s and resn %s)' % (obj, '+'.join(WATERS))
+        ions = 'resn %s' % '+'.join(sorted(ION_CHARGES))
+        if self.ionseg.getvalue():
+            ions += ' or segi %s' % self.ionseg.getvalue()
+        ions = '(%s and (%s))' % (obj, ions)
+        solute = '(%s and not %s and not %s)' % (obj, solvent, ions)
+
+        nsolvent = cmd.count_atoms(solvent)
+        policy = self.soldisp.getvalue()
+        if policy == 'auto':
+            if nsolvent > SOLVENT_HIDDEN:
+                policy = 'hidden'
+            elif nsolvent > SOLVENT_SPHERES:
+                policy = 'spheres'
+            else:
+                policy = 'lines'
+
+        cmd.hide('everything', obj)
+        if cmd.count_atoms(solute) > SOLVENT_SPHERES:
+            cmd.show('lines', solute)
+        else:
+            cmd.show('sticks', solute)
+        cmd.show('spheres', ions)
+        if policy == 'spheres':
+            try:
+                cmd.set('sphere_scale', 0.2, solvent)
+                cmd.show('spheres', solvent)
+            except Exception as e:
+                print('Failed to show the solvent as spheres: %s' % e)
+                policy = 'lines'
+        if policy == 'lines':
+            cmd.show('lines', solvent)
+        if self.use_shell.get() and self.shellsel.getvalue():
+            try:
+                cmd.show('lines', 'byres (%s within %s of (%s))' % (
+                        solvent, float(self.shellcut.getvalue() or 0),
+                        self.shellsel.getvalue()))
+            except Exception as e:
+                print('Invalid solvent shell selection: %s' % e)
+
+    def run_stage(self, name, *args):
+        """Run a stage on self.mod, in the worker process where possible.
+
+        The worker keeps its own copy of the model, so self.mod is only
+        replaced when the stage succeeds and the interface stays
+        responsive while it runs.
+        """
+        if os.name != 'posix':
+            mod = WORKER_STAGES[name](self.mod, *args)
+            self.mod = as_columns(mod)
+            return
+        if self.worker is None:
+            self.worker = StageWorker()
+        Pmw.showbusycursor()
+        try:
+            if self.mod is not self.remote:
+                self.worker.load(self.mod, self.parent.update)
+            self.mod = self.remote = self.worker.run(name, args,
+                                                     self.parent.update)
+        finally:
+            Pmw.hidebusycursor()
+
+    def show_stage_error(self, stage, e):
+        tb = getattr(e, 'tb', None) or traceback.format_exc()
+        print('%s failed:\n%s' % (stage, tb))
+        tkMessageBox.showerror('ERROR', '%s failed\n\n%s' % (stage, e),
+                               parent=self.parent)
+
+    def discard_ensemble(self):
+        if self.ensemble:
+            print('Only the first model is kept from now on')
+        self.ensemble = None
 
     def on_output_button_clicked(self):
         # check
@@ -1099,10 +1581,29 @@ class EmdyGui:
             return
 
         ffinfo = int(self.top.titles[-1].split()[0]), self.top.titles[0]
-        save_files(self.mod, self.prm, self.topfmt.getvalue(),
-                   self.toploc.getvalue(), self.crdfmt.getvalue(),
-                   self.crdloc.getvalue(), ffinfo)
-        tkMessageBox.showinfo('INFO', '2 files were generated',
+        hmass = None
+        if self.use_hmr.get():
+            hmass = float(self.hmass.getvalue())
+        parfile = None
+        if self.use_pruned.get():
+            parfile = self.parloc.getvalue()
+        args = (self.prm, self.topfmt.getvalue(), self.toploc.getvalue(),
+                self.crdfmt.getvalue(), self.crdloc.getvalue(), ffinfo,
+                self.ensemble, hmass, self.water, parfile, self.top)
+        Pmw.showbusycursor()
+        try:
+            if self.mod is self.remote:
+                # the worker holds the model with its topology
+                nfiles = self.worker.call('save_files', args,
+                                          self.parent.update)
+            else:
+                nfiles = save_files(self.mod, *args)
+        except Exception as e:
+            self.show_stage_error('Output', e)
+            return
+        finally:
+            Pmw.hidebusycursor()
+        tkMessageBox.showinfo('INFO', '%d files were generated' % nfiles,
                               parent=self.parent)
 
     def on_console_button_clicked(self):
@@ -1125,14 +1626,24 @@ class EmdyGui:
         for obj in self.pmobj:
             cmd.delete(obj)
         self.dialog.withdraw()
+        if self.worker is not None:
+            self.worker.close()
+            self.worker = self.remote = None
 
     def on_download_clicked(self):
         pdb = self.pdbloc.getvalue()
         try:
             PdbFile.download(pdb)
         except Exception:
-            tkMessageBox.showerror('ERROR', 'Failed to download "%s"'%pdb,
-                                   parent=self.parent)
+            # large entries are only distributed as mmCIF
+            try:
+                fname = download_cif(pdb, os.getcwd())
+            except Exception:
+                tkMessageBox.showerror('ERROR', 'Failed to download "%s"'%pdb,
+                                       parent=self.parent)
+                return
+            self.pdbloc.setvalue(os.path.abspath(fname))
+            self.on_pdbentry_pressed()
         else:
             self.pdbloc.setvalue(os.path.join(os.getcwd(), pdb.upper()+'.pdb'))
             self.on_pdbentry_pressed()
@@ -1140,7 +1651,20 @@ class EmdyGui:
     def on_pdbentry_pressed(self):
         pdb = self.pdbloc.getvalue()
         if self.check_exist(pdb) == Pmw.OK:
-            cmd.load(pdb, 'original', format='pdb', quiet=0)
+            try:
+                f = input_file(pdb)
+            except ImportError as e:
+                tkMessageBox.showerror('ERROR', str(e), parent=self.parent)
+                return
+            fmt = 'cif' if _HAS_LIB and is_cif(pdb) else 'pdb'
+            if f is pdb:
+                cmd.load(pdb, 'original', format=fmt, quiet=0)
+            elif fmt == 'cif':
+                with f:
+                    cmd.load_raw(f.read(), 'cif', 'original')
+            else:
+                with f:
+                    cmd.read_pdbstr(f.read(), 'original')
             util.cbag()
             self.pmobj.append('original')
 
@@ -1149,6 +1673,13 @@ class EmdyGui:
                 tkFileDialog.askopenfilename(
                     defaultextension='.pdb .ent',
                     filetypes=[('PDB File', '.pdb .ent'),
+                               ('mmCIF File', '.cif .mmcif'),
+                               ('Compressed PDB File',
+                                ' '.join(e + z for e in ('.pdb', '.ent')
+                                         for z in compressed_exts())),
+                               ('Compressed mmCIF File',
+                                ' '.join(e + z for e in ('.cif', '.mmcif')
+                                         for z in compressed_exts())),
                                ('All Files', '.*')]))
         self.on_pdbentry_pressed()
 
@@ -1176,6 +1707,8 @@ class EmdyGui:
                 tkFileDialog.asksaveasfilename(
                     defaultextension=top,
                     filetypes=[('Topology File', top),
+                               ('Compressed Topology File',
+                                ' '.join(top + z for z in compressed_exts())),
                                ('All Files', '.*')]))
 
     def on_savecrd_clicked(self, event=None):
@@ -1189,6 +1722,8 @@ class EmdyGui:
                 tkFileDialog.asksaveasfilename(
                     defaultextension=crd,
                     filetypes=[('Coordinate File', crd),
+                               ('Compressed Coordinate File',
+                                ' '.join(crd + z for z in compressed_exts())),
                                ('All Files', '.*')]))
 
     def on_openren_clicked(self, event=None):
@@ -1243,14 +1778,1831 @@ class EmdyGui:
 
 if _HAS_LIB:
 
-    def add_atoms(mod, top, prm):
-        builder = CharmmTopBuilder(mod, top)
-        mod = builder.build()
-        cbuilder = CharmmCoordBuilder(mod, prm)
-        mod = cbuilder.complete_coords()
+    def _str(s):
+        if not isinstance(s, str):
+            s = s.decode('ascii')
+        return s.strip()
+
+    class StringTable:
+        """Interned strings coded as small integers."""
+
+        def __init__(self, strings=()):
+            self.strings = []
+            self.index = {}
+            for s in strings:
+                self.code(s)
+
+        def __len__(self):
+            return len(self.strings)
+
+        def __getitem__(self, i):
+            return self.strings[i]
+
+        def code(self, s):
+            try:
+                return self.index[s]
+            except KeyError:
+                i = self.index[s] = len(self.strings)
+                self.strings.append(s)
+                return i
+
+        def encode(self, strings):
+            """Code a sequence of strings, or an array of fixed-width bytes."""
+            strings = np.asarray(strings)
+            if strings.dtype.kind == 'S' and strings.itemsize in (1, 2, 4, 8):
+                # sorting the bytes as integers is much faster
+                ints = strings.view('u%d' % strings.itemsize)
+                uniq, inv = np.unique(ints, return_inverse=True)
+                uniq = uniq.view(strings.dtype)
+            else:
+                uniq, inv = np.unique(strings, return_inverse=True)
+            codes = np.array([self.code(_str(s)) for s in uniq],
+                             dtype=np.int32)
+            return codes[inv.reshape(-1)]
+
+        def decode(self, codes):
+            return np.array(self.strings, dtype=object)[codes]
+
+    class ColumnarModel:
+        """Structure-of-arrays view of a model.
+
+        Every per-atom property is a NumPy column and every string property
+        is coded against a shared StringTable, so an atom costs 69 bytes:
+
+            coords (3 x float64) 24, charges 8, masses 8, names 4, types 4,
+            resnames 4, resids 4, icodes 4, chains 4, segids 4, hetatm 1
+
+        That is about 6.9 MB at 100k atoms and 69 MB at 1M atoms, against
+        roughly 1 KB per atom (1 GB at 1M atoms) for a list of Python atom
+        objects with their attribute dicts, floats and strings.
+
+        A model that already carries a topology is kept as the backing
+        model and returned by to_model(); otherwise the columns are the only
+        copy and to_model() rebuilds an EMDY model from them on demand.
+        """
+
+        COLUMNS = ('coords', 'charges', 'masses', 'names', 'types',
+                   'resnames', 'resids', 'icodes', 'chains', 'segids',
+                   'hetatm')
+
+        def __init__(self, natoms=0, strings=None):
+            self.coords = np.zeros((natoms, 3))
+            self.charges = np.zeros(natoms)
+            self.masses = np.zeros(natoms)
+            self.names = np.zeros(natoms, dtype=np.int32)
+            self.types = np.zeros(natoms, dtype=np.int32)
+            self.resnames = np.zeros(natoms, dtype=np.int32)
+            self.resids = np.zeros(natoms, dtype=np.int32)
+            self.icodes = np.zeros(natoms, dtype=np.int32)
+            self.chains = np.zeros(natoms, dtype=np.int32)
+            self.segids = np.zeros(natoms, dtype=np.int32)
+            self.hetatm = np.zeros(natoms, dtype=bool)
+            if strings is None:
+                strings = StringTable([''])
+            self.strings = strings
+            self.model = None
+            self.box = None
+
+        def __len__(self):
+            return len(self.charges)
+
+        @property
+        def nbytes(self):
+            return sum(a.nbytes for a in self.columns())
+
+        def columns(self):
+            return tuple(getattr(self, attr) for attr in self.COLUMNS)
+
+        @classmethod
+        def from_model(cls, mod):
+            atoms = mod.atoms
+            self = cls(len(atoms))
+            self.coords[:] = mod.coords
+            self.charges[:] = [getattr(a, 'charge', 0.0) for a in atoms]
+            self.masses[:] = [getattr(a, 'mass', 0.0) for a in atoms]
+            self.resids[:] = [getattr(a, 'resid', 0) for a in atoms]
+            self.hetatm[:] = [getattr(a, 'hetero', False) for a in atoms]
+            for col, attr in ((self.names, 'name'), (self.types, 'type'),
+                              (self.resnames, 'resname'),
+                              (self.icodes, 'icode'),
+                              (self.chains, 'chain'),
+                              (self.segids, 'segname')):
+                col[:] = self.strings.encode(
+                        [getattr(a, attr, None) or '' for a in atoms])
+            self.box = getattr(mod, 'box', None)
+            if getattr(mod, 'bonds', None):
+                self.model = mod
+            return self
+
+        def take(self, idx):
+            """New ColumnarModel of the atoms idx, sharing the strings."""
+            cols = ColumnarModel(0, self.strings)
+            for attr in self.COLUMNS:
+                setattr(cols, attr, getattr(self, attr)[idx])
+            cols.box = self.box
+            return cols
+
+        # one-atom record read for the model and atom classes of EMDY
+        PROTOTYPE = ('ATOM      1  X   UNK X   1       0.000   0.000   0.000'
+                     '  1.00  0.00      X\nEND\n')
+
+        def to_model(self):
+            """The backing model, or an EMDY model built from the columns.
+
+            The atoms are copies of a prototype atom with every field set
+            from the columns, so chains, resids, serials and segids keep
+            their full width instead of the fixed PDB columns.
+            """
+            if self.model is not None:
+                return self.model
+            proto = PdbFile(StringIO(self.PROTOTYPE)).read()
+            atom = proto.atoms[0]
+            mod = empty_like(proto)
+            s = self.strings.decode
+            rows = zip(s(self.names), s(self.types), s(self.resnames),
+                       self.resids.tolist(), s(self.icodes), s(self.chains),
+                       s(self.segids), self.charges.tolist(),
+                       self.masses.tolist(), self.hetatm.tolist())
+            atoms = mod.atoms
+            for i, row in enumerate(rows):
+                a = copy.copy(atom)
+                (a.name, a.type, a.resname, a.resid, a.icode, a.chain,
+                 a.segname, a.charge, a.mass, a.hetero) = row
+                if hasattr(atom, 'serial'):
+                    a.serial = i + 1
+                atoms.append(a)
+            mod.coords = self.coords.copy()
+            if self.box is not None:
+                mod.box = self.box
+            return mod
+
+        def total_charge(self):
+            return fsum(self.charges)
+
+        def write_pdb(self, fp):
+            s = self.strings.decode
+            names = [n if len(n) > 3 or n[:1].isdigit() else ' ' + n
+                     for n in s(self.names)]
+            rows = zip(np.where(self.hetatm, 'HETATM', 'ATOM  ').tolist(),
+                       (np.arange(1, len(self) + 1) % 100000).tolist(),
+                       names, s(self.resnames), s(self.chains),
+                       (self.resids % 10000).tolist(), s(self.icodes),
+                       self.coords.tolist(), s(self.segids))
+            fmt = ('%-6s%5d %-4s %-4s%1.1s%4d%1.1s   %8.3f%8.3f%8.3f'
+                   '  1.00  0.00      %-4s\n')
+            write = fp.write
+            box = self.box
+            if box is not None and len(box) >= 3:
+                angles = tuple(box[3:6]) if len(box) >= 6 else (90.0,) * 3
+                write('CRYST1%9.3f%9.3f%9.3f%7.2f%7.2f%7.2f P 1           1\n'
+                      % (tuple(box[:3]) + angles))
+            for (rec, i, name, resname, chain, resid, icode, xyz,
+                    segid) in rows:
+                write(fmt % (rec, i, name, resname, chain, resid, icode,
+                             xyz[0], xyz[1], xyz[2], segid))
+            write('END\n')
+
+    def hy36decode(s):
+        """Decode a PDB integer field, including hybrid-36 overflow."""
+        s = _str(s)
+        try:
+            return int(s)
+        except ValueError:
+            pass
+        w = len(s)
+        if not s or not s.isalnum():
+            return 0
+        if s[0].isupper():
+            return int(s, 36) - 10 * 36**(w - 1) + 10**w
+        return int(s, 36) + 16 * 36**(w - 1) + 10**w
+
+    def pdb_lines(buf):
+        ends = np.flatnonzero(buf == 10)
+        if len(buf) and buf[-1] != 10:
+            ends = np.append(ends, len(buf))
+        starts = np.append(0, ends[:-1] + 1)
+        return starts, ends
+
+    def pdb_column(buf, starts, ends, a, b):
+        """Slice columns [a, b) of every line into an array of byte strings.
+
+        Short lines are padded with blanks, as the PDB format requires.
+        """
+        if not len(starts):
+            return np.zeros(0, dtype='S%d' % (b - a))
+        idx = starts[:, None] + np.arange(a, b)
+        if (ends - starts).min() > b:
+            chars = buf[idx]
+        else:
+            chars = buf[np.minimum(idx, len(buf) - 1)]
+            chars = np.where(idx < ends[:, None], chars, 32).astype(np.uint8)
+            chars[chars == 13] = 32
+        return chars.view('S%d' % (b - a)).ravel()
+
+    def pdb_int_column(col):
+        try:
+            return col.astype(np.int64)
+        except ValueError:
+            uniq, inv = np.unique(col, return_inverse=True)
+            return np.array([hy36decode(u) for u in uniq],
+                            dtype=np.int64)[inv.reshape(-1)]
+
+    def column_in(col, names):
+        """Whether each stripped entry of a byte-string column is in
+        names, testing every distinct entry once."""
+        uniq, inv = np.unique(col, return_inverse=True)
+        hit = np.array([_str(u) in names for u in uniq], dtype=bool)
+        return hit[inv.reshape(-1)]
+
+    class HydrogenNames:
+        """Container of atom names that denote hydrogens, such as HA,
+        1HB or HG11, for atoms without an element column."""
+
+        def __contains__(self, name):
+            return name.lstrip('0123456789')[:1] in ('H', 'D')
+
+    class RecordFilter:
+        """Predicate dropping hydrogens, ligands, water or ions from
+        ATOM/HETATM records before they are parsed into columns.
+
+        Called with the record arrays of parse_pdb_records, it returns the
+        mask of records to keep and adds up in removed how many atoms each
+        filter matched.
+        """
+
+        ion_names = frozenset(tuple(ION_CHARGES) +
+                              ('NA', 'K', 'CL', 'CA', 'MG', 'ZN', 'LI', 'RB',
+                               'CS', 'CD', 'MN', 'FE', 'CO', 'NI', 'CU'))
+        water_names = frozenset(WATERS)
+
+        def __init__(self, hydrogens=False, ligands=False, water=False,
+                     ions=False):
+            self.filters = [f for f, on in (('hydrogens', hydrogens),
+                                            ('ligands', ligands),
+                                            ('water', water),
+                                            ('ions', ions)) if on]
+            self.removed = dict((f, 0) for f in self.filters)
+
+        def __bool__(self):
+            return bool(self.filters)
+
+        __nonzero__ = __bool__
+
+        def __call__(self, buf, starts, ends, rec):
+            if not self.filters or not len(starts):
+                return np.ones(len(starts), dtype=bool)
+            return self.mask(rec == b'HETATM',
+                             pdb_column(buf, starts, ends, 17, 21),
+                             pdb_column(buf, starts, ends, 12, 16),
+                             pdb_column(buf, starts, ends, 76, 78))
+
+        def mask(self, hetatm, resnames, names, elements):
+            """The records to keep, given their HETATM flags and their
+            residue name, atom name and element columns."""
+            keep = np.ones(len(hetatm), dtype=bool)
+            water = column_in(resnames, self.water_names)
+            ion = column_in(resnames, self.ion_names)
+            for f in self.filters:
+                if f == 'hydrogens':
+                    hit = column_in(elements, ('H', 'D'))
+                    blank = column_in(elements, ('', '.', '?'))
+                    hit[blank] = column_in(names[blank], HydrogenNames())
+                elif f == 'ligands':
+                    hit = hetatm & ~water & ~ion
+                elif f == 'water':
+                    hit = water
+                else:
+                    hit = ion
+                hit &= keep
+                self.removed[f] += int(np.count_nonzero(hit))
+                keep &= ~hit
+            return keep
+
+        def report(self):
+            return ', '.join('%s %d' % (f, self.removed[f])
+                             for f in self.filters)
+
+    def parse_pdb_records(buf, starts, ends, rec, predicate=None):
+        keep = (rec == b'ATOM  ') | (rec == b'HETATM')
+        altloc = pdb_column(buf, starts, ends, 16, 17)
+        keep &= (altloc == b' ') | (altloc == b'A') | (altloc == b'1')
+        starts, ends, rec = starts[keep], ends[keep], rec[keep]
+        if predicate:
+            keep = predicate(buf, starts, ends, rec)
+            starts, ends, rec = starts[keep], ends[keep], rec[keep]
+
+        cols = ColumnarModel(len(starts))
+        cols.hetatm[:] = rec == b'HETATM'
+        for i, (a, b) in enumerate(((30, 38), (38, 46), (46, 54))):
+            cols.coords[:, i] = pdb_column(buf, starts, ends, a, b).astype(
+                    np.float64)
+        cols.resids[:] = pdb_int_column(pdb_column(buf, starts, ends, 22, 26))
+        encode = cols.strings.encode
+        cols.names[:] = encode(pdb_column(buf, starts, ends, 12, 16))
+        cols.resnames[:] = encode(pdb_column(buf, starts, ends, 17, 21))
+        cols.icodes[:] = encode(pdb_column(buf, starts, ends, 26, 27))
+        cols.chains[:] = encode(pdb_column(buf, starts, ends, 21, 22))
+        cols.segids[:] = encode(pdb_column(buf, starts, ends, 72, 76))
+        return cols
+
+    def parse_cryst1(buf, starts, ends, rec):
+        """The box (a, b, c, alpha, beta, gamma) of the first CRYST1
+        record, or None."""
+        found = np.flatnonzero(rec == b'CRYST1')[:1]
+        if not len(found):
+            return None
+        try:
+            return [float(pdb_column(buf, starts[found], ends[found],
+                                     a, b)[0])
+                    for a, b in ((6, 15), (15, 24), (24, 33),
+                                 (33, 40), (40, 47), (47, 54))]
+        except ValueError:
+            return None
+
+    def parse_pdb_models(buf, maxmodels=None, predicate=None):
+        """Parse every MODEL (up to maxmodels) into a ColumnarModel,
+        keeping the records predicate accepts.  The CRYST1 box is given
+        to every model."""
+        starts, ends = pdb_lines(buf)
+        rec = pdb_column(buf, starts, ends, 0, 6)
+        box = parse_cryst1(buf, starts, ends, rec)
+        bounds = np.append(0, np.flatnonzero(rec == b'ENDMDL') + 1).tolist()
+        bounds.append(len(rec))
+        models = []
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            cols = parse_pdb_records(buf, starts[a:b], ends[a:b], rec[a:b],
+                                     predicate)
+            cols.box = box
+            if len(cols):
+                models.append(cols)
+            if len(models) == maxmodels:
+                break
+        return models or [ColumnarModel()]
+
+    def read_pdb_models(fname, maxmodels=None, predicate=None):
+        """Read the ATOM/HETATM records of a PDB file into ColumnarModels.
+
+        Plain files are memory-mapped and every field is sliced out of the
+        mapped bytes for all records at once.  Only the first alternate
+        location is kept.
+        """
+        f = input_file(fname)
+        if f is not fname:
+            with f:
+                return parse_pdb_models(np.frombuffer(f.read(),
+                                                      dtype=np.uint8),
+                                        maxmodels, predicate)
+        with open(fname, 'rb') as fp:
+            if not os.fstat(fp.fileno()).st_size:
+                return [ColumnarModel()]
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return parse_pdb_models(np.frombuffer(buf, dtype=np.uint8),
+                                        maxmodels, predicate)
+            finally:
+                buf.close()
+
+    def read_pdb(fname, predicate=None):
+        """Read the first model of a PDB file into a ColumnarModel."""
+        return read_pdb_models(fname, 1, predicate)[0]
+
+    def is_cif(fname):
+        """Whether fname names an mmCIF file, possibly compressed."""
+        root, ext = os.path.splitext(fname.lower())
+        if ext in compressed_exts():
+            root, ext = os.path.splitext(root)
+        return ext in ('.cif', '.mmcif')
+
+    def read_input_filtered(fname, maxmodels=None, predicate=None):
+        """Read a PDB or mmCIF file into ColumnarModels, also returning
+        the counts of atoms the predicate removed, which a worker process
+        cannot update in place."""
+        if is_cif(fname):
+            models = read_cif_models(fname, maxmodels, predicate)
+        else:
+            models = read_pdb_models(fname, maxmodels, predicate)
+        return models, getattr(predicate, 'removed', None)
+
+    # _atom_site items read into the columns, with their fallbacks
+    CIF_ITEMS = (('group', ('group_PDB',)), ('alt', ('label_alt_id',)),
+                 ('x', ('Cartn_x',)), ('y', ('Cartn_y',)),
+                 ('z', ('Cartn_z',)),
+                 ('name', ('auth_atom_id', 'label_atom_id')),
+                 ('resname', ('auth_comp_id', 'label_comp_id')),
+                 ('chain', ('auth_asym_id', 'label_asym_id')),
+                 ('resid', ('auth_seq_id', 'label_seq_id')),
+                 ('icode', ('pdbx_PDB_ins_code',)),
+                 ('element', ('type_symbol',)),
+                 ('model', ('pdbx_PDB_model_num',)))
+
+    CIF_TOKEN = re.compile(r"""'[^']*'(?=\s)|"[^"]*"(?=\s)|\S+""")
+
+    def cif_unquote(col):
+        """Strip the mmCIF quotes from a column, once per distinct value."""
+        uniq, inv = np.unique(col, return_inverse=True)
+        plain = [u[1:-1] if len(u) > 1 and u[0] == u[-1] and u[0] in '\'"'
+                 else u for u in uniq.tolist()]
+        return np.array(plain)[inv.reshape(-1)]
+
+    def parse_cif_rows(text, fields, n, predicate=None, strings=None):
+        """Parse _atom_site rows of n items into a ColumnarModel and their
+        model numbers.  fields maps the CIF_ITEMS keys to item positions."""
+        if '"' in text or "'" in text:
+            tokens = CIF_TOKEN.findall(text)
+        else:
+            tokens = text.split()
+        if len(tokens) % n:
+            raise ValueError('_atom_site rows do not have %d items' % n)
+
+        def column(key, default='.'):
+            i = fields.get(key)
+            if i is None:
+                return np.array([default] * (len(tokens) // n))
+            return np.array(tokens[i::n])
+
+        keep = np.ones(len(tokens) // n, dtype=bool)
+        if 'alt' in fields:
+            keep = column_in(column('alt'), ('.', '?', 'A', '1'))
+        hetatm = column('group', 'ATOM') == 'HETATM'
+        resnames = cif_unquote(column('resname'))
+        names = cif_unquote(column('name'))
+        if predicate:
+            keep &= predicate.mask(hetatm, resnames, names,
+                                   column('element'))
+        idx = np.flatnonzero(keep)
+        cols = ColumnarModel(len(idx), strings)
+        cols.hetatm[:] = hetatm[idx]
+        for i, key in enumerate('xyz'):
+            cols.coords[:, i] = np.fromiter(map(float, tokens[fields[key]::n]),
+                                            np.float64)[idx]
+        try:
+            resids = np.fromiter(map(int, tokens[fields['resid']::n]),
+                                 np.int64)
+        except (KeyError, ValueError):
+            resids = pdb_int_column(column('resid', '0'))
+        cols.resids[:] = resids[idx]
+        encode = cols.strings.encode
+        icodes = cif_unquote(column('icode')[idx])
+        cols.icodes[:] = encode(np.where((icodes == '.') | (icodes == '?'),
+                                         '', icodes))
+        cols.names[:] = encode(names[idx])
+        cols.resnames[:] = encode(resnames[idx])
+        # mmCIF has no segment column; chain ids of any length serve
+        cols.chains[:] = encode(cif_unquote(column('chain')[idx]))
+        cols.segids[:] = cols.chains
+        return cols, pdb_int_column(column('model', '1')[idx])
+
+    def read_cif_models(fname, maxmodels=None, predicate=None,
+                        chunksize=1 << 22):
+        """Read the _atom_site loop of an mmCIF file into ColumnarModels.
+
+        The rows are read about chunksize bytes at a time and each chunk is
+        tokenized and converted column by column, so only the columns and
+        one chunk of text are held at once.  Reading stops after maxmodels
+        models.  Only the first alternate location is kept.
+        """
+        f = input_file(fname)
+        if f is fname:
+            f = open(fname, 'rb')
+        parts = []
+        order = []
+        strings = StringTable([''])
+        with f:
+            items = []
+            first = b''
+            for raw in iter(f.readline, b''):
+                line = raw if isinstance(raw, str) else raw.decode('ascii')
+                if line.startswith('_atom_site.'):
+                    items.append(line.split()[0][11:])
+                elif items:
+                    first = raw
+                    break
+            fields = {}
+            for key, names in CIF_ITEMS:
+                for name in names:
+                    if name in items:
+                        fields[key] = items.index(name)
+                        break
+            if items and not all(k in fields for k in 'xyz'):
+                raise ValueError('%s has no _atom_site coordinates' % fname)
+            pending = [first]
+            done = not items
+            while not done:
+                lines = pending + f.readlines(chunksize)
+                pending = []
+                if not any(lines):
+                    break
+                text = b''.join(lines)
+                if not isinstance(text, str):
+                    text = text.decode('ascii', 'replace')
+                ends = [text.find(tag) for tag in ('\n#', '\n_', '\nloop_',
+                                                   '\ndata_')]
+                ends = [i + 1 for i in ends if i >= 0]
+                if text[:1] in ('#', '_') or text[:5] in ('loop_', 'data_'):
+                    ends.append(0)
+                if ends:
+                    text = text[:min(ends)]
+                    done = True
+                cols, models = parse_cif_rows(text, fields, len(items),
+                                              predicate, strings)
+                for m in np.unique(models).tolist():
+                    if m not in order:
+                        order.append(m)
+                if maxmodels and len(order) > maxmodels:
+                    keep = np.zeros(max(order) + 1, dtype=bool)
+                    keep[order[:maxmodels]] = True
+                    cols = cols.take(np.flatnonzero(keep[models]))
+                    models = models[keep[models]]
+                    done = True
+                parts.append((cols, models))
+        if not parts:
+            return [ColumnarModel()]
+        whole = ColumnarModel(0, strings)
+        for attr in ColumnarModel.COLUMNS:
+            setattr(whole, attr, np.concatenate([getattr(c, attr)
+                                                 for c, m in parts]))
+        models = np.concatenate([m for c, m in parts])
+        if len(order) < 2:
+            return [whole]
+        return [whole.take(np.flatnonzero(models == m))
+                for m in order[:maxmodels]]
+
+    def read_cif(fname, predicate=None):
+        """Read the first model of an mmCIF file into a ColumnarModel."""
+        return read_cif_models(fname, 1, predicate)[0]
+
+    def download_cif(code, dirname='.'):
+        """Fetch the mmCIF file of a PDB entry, for entries too large for
+        the PDB format, and return its path."""
+        fname = os.path.join(dirname, '%s.cif.gz' % code.upper())
+        src = urllib2.urlopen(CIF_URL % code.upper(), timeout=60)
+        try:
+            with open(fname, 'wb') as fp:
+                shutil.copyfileobj(src, fp)
+        finally:
+            src.close()
+        return fname
+
+    def read_selection_models(selection, maxmodels=None, predicate=None):
+        """Read the atoms of a PyMOL selection into ColumnarModels, one
+        per state.
+
+        PyMOL writes the selection out as PDB text in C, which the
+        vectorized PDB parser then reads; walking the atoms returned by
+        cmd.get_model() is several times slower.
+        """
+        state = -1 if maxmodels == 1 else 0
+        buf = cmd.get_pdbstr(selection, state)
+        if not isinstance(buf, bytes):
+            buf = buf.encode('ascii')
+        return parse_pdb_models(np.frombuffer(buf, dtype=np.uint8),
+                                maxmodels, predicate)
+
+    def read_selection(selection, predicate=None):
+        """Read the current state of a PyMOL selection."""
+        return read_selection_models(selection, 1, predicate)[0]
+
+    def parse_biomt(lines, biomol=1):
+        """Transforms of one biomolecule from REMARK 350 lines.
+
+        Returns a list of (chains, matrices), chains being the set of chain
+        ids the (m, 3, 4) matrices apply to, or None for every chain.
+        """
+        groups = []
+        current = None
+        for line in lines:
+            text = line[10:].strip()
+            words = text.split()
+            if text.startswith('BIOMOLECULE:'):
+                current = int(words[1])
+            elif current != biomol or not words:
+                continue
+            elif text.startswith('APPLY THE FOLLOWING TO CHAINS:'):
+                groups.append((set(), {}))
+                text = text.split(':', 1)[1]
+                groups[-1][0].update(c.strip() for c in text.split(','))
+            elif text.startswith('AND CHAINS:') and groups:
+                text = text.split(':', 1)[1]
+                groups[-1][0].update(c.strip() for c in text.split(','))
+            elif words[0][:5] == 'BIOMT' and len(words) >= 6:
+                if not groups:
+                    groups.append((None, {}))
+                mat = groups[-1][1].setdefault(int(words[1]),
+                                               np.zeros((3, 4)))
+                mat[int(words[0][5:]) - 1] = [float(w) for w in words[2:6]]
+        result = []
+        for chains, mats in groups:
+            if chains is not None:
+                chains.discard('')
+            if mats:
+                result.append((chains or None,
+                               np.array([mats[k] for k in sorted(mats)])))
+        return result
+
+    def read_biomt(fname):
+        """Read the BIOMT transforms of the first biomolecule, stopping
+        at the first coordinate record."""
+        f = input_file(fname)
+        if f is fname:
+            f = open(fname, 'rb')
+        with f:
+            lines = takewhile(
+                    lambda l: l[:6] not in (b'ATOM  ', b'HETATM'), f)
+            return parse_biomt(l.decode('ascii', 'replace') for l in lines
+                               if l[:10] == b'REMARK 350')
+
+    class RenameRules:
+        """Rename rules compiled into dicts keyed by name.
+
+        atoms and terminal map (residue name, atom name) to the new atom
+        name; anyatoms holds the '*' rules.  update() lets a later rule set
+        override an earlier one.
+        """
+
+        def __init__(self, data=None):
+            self.residues = {}
+            self.atoms = {}
+            self.terminal = {}
+            self.anyatoms = {}
+            if data:
+                self.compile(data)
+
+        def compile(self, data):
+            for old, new in (data.get('residues') or {}).items():
+                self.residues[str(old)] = str(new)
+            for section, table in (('atoms', self.atoms),
+                                   ('terminal', self.terminal)):
+                for resnames, names in (data.get(section) or {}).items():
+                    for resname in str(resnames).split(','):
+                        resname = resname.strip()
+                        for old, new in names.items():
+                            if resname == '*' and section == 'atoms':
+                                self.anyatoms[str(old)] = str(new)
+                            else:
+                                table[resname, str(old)] = str(new)
+
+        def update(self, other):
+            self.residues.update(other.residues)
+            self.atoms.update(other.atoms)
+            self.terminal.update(other.terminal)
+            self.anyatoms.update(other.anyatoms)
+
+        def __len__(self):
+            return (len(self.residues) + len(self.atoms) +
+                    len(self.terminal) + len(self.anyatoms))
+
+    _RULE_CACHE = {}
+
+    def load_rules(fname=None):
+        """Compiled rules of a YAML rule file, or the default rules.
+
+        Compiled rule sets are cached by the SHA-1 of the file content, so
+        an unchanged file is parsed once per session.
+        """
+        if fname is None:
+            key = 'default'
+        else:
+            with open(fname, 'rb') as f:
+                text = f.read()
+            key = hashlib.sha1(text).hexdigest()
+        try:
+            return _RULE_CACHE[key]
+        except KeyError:
+            pass
+        if fname is None:
+            rules = RenameRules(DEFAULT_RULES)
+        elif yaml is None:
+            raise ImportError('PyYAML is needed to read %s' % fname)
+        else:
+            rules = RenameRules(yaml.safe_load(text) or {})
+        _RULE_CACHE[key] = rules
+        return rules
+
+    def name_map(strings, table):
+        """Code-to-code lookup array for a {old name: new name} dict."""
+        new = [strings.code(v) for v in table.values()]
+        lut = np.arange(len(strings), dtype=np.int32)
+        old = [strings.index.get(k, -1) for k in table]
+        for o, n in zip(old, new):
+            if o >= 0:
+                lut[o] = n
+        return lut
+
+    def pair_map(strings, table):
+        """Sorted (residue code, atom code) keys and the new atom codes
+        for a {(residue name, atom name): new name} dict."""
+        index = strings.index
+        items = [(index[r], index[a], strings.code(v))
+                 for (r, a), v in table.items()
+                 if r in index and a in index]
+        if not items:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+        items = np.array(items, dtype=np.int64)
+        keys = items[:, 0] * (1 << 32) + items[:, 1]
+        order = np.argsort(keys)
+        return keys[order], items[order, 2].astype(np.int32)
+
+    def lookup_pairs(keys, values, resnames, names):
+        """New atom codes and a hit mask for every (resname, name) row."""
+        if not len(keys):
+            return names, np.zeros(len(names), dtype=bool)
+        k = resnames.astype(np.int64) * (1 << 32) + names
+        pos = np.minimum(np.searchsorted(keys, k), len(keys) - 1)
+        hit = keys[pos] == k
+        return np.where(hit, values[pos], names), hit
+
+    def apply_rules(cols, rules):
+        """Rename the residues and atoms of cols in place in one pass.
+
+        Residue renames come first; atom rules are then matched on the new
+        residue names, a residue-specific rule winning over a terminal
+        rule and a terminal rule over a '*' rule.  Returns the numbers of
+        atoms whose residue name and atom name changed.
+        """
+        strings = cols.strings
+        resnames = name_map(strings, rules.residues)[cols.resnames]
+        akeys, avals = pair_map(strings, rules.atoms)
+        tkeys, tvals = pair_map(strings, rules.terminal)
+        anymap = name_map(strings, rules.anyatoms)
+
+        names, hit = lookup_pairs(akeys, avals, resnames, cols.names)
+        if len(tkeys):
+            # atoms of the last polymer residue of each segment
+            last = chain_termini(cols)[1]
+            tnames, thit = lookup_pairs(tkeys, tvals, resnames, cols.names)
+            thit &= last & ~hit
+            names = np.where(thit, tnames, names)
+            hit |= thit
+        names = np.where(hit, names, anymap[cols.names])
+
+        nres = np.count_nonzero(resnames != cols.resnames)
+        nnames = np.count_nonzero(names != cols.names)
+        cols.resnames = resnames.astype(np.int32)
+        cols.names = names.astype(np.int32)
+        return nres, nnames
+
+    def read_charmm_top(fname):
+        return CharmmTopFile(fname).read()
+
+    def read_charmm_prm(fname):
+        return CharmmPrmFile(fname).read()
+
+    def timed_call(func, *args):
+        t0 = time.time()
+        try:
+            with child_output():
+                return True, func(*args), time.time() - t0
+        except Exception:
+            return False, traceback.format_exc(), time.time() - t0
+
+    def _init_child(initializer, initargs):
+        # a forked child inherits the GUI console as stdout
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+        if initializer is not None:
+            initializer(*initargs)
+
+    @contextmanager
+    def child_output():
+        """Collect what a pool job prints when it runs in a child
+        process, yielding the buffer for the parent to print.  In the
+        main process (and in thread pools) nothing is redirected."""
+        buf = StringIO()
+        if multiprocessing.current_process().name == 'MainProcess':
+            yield buf
+            return
+        old = sys.stdout
+        sys.stdout = buf
+        try:
+            yield buf
+        finally:
+            sys.stdout = old
+
+    class ParseError(Exception):
+        def __init__(self, fname, tb):
+            Exception.__init__(self, fname)
+            self.fname = fname
+            self.tb = tb
+
+    def make_pool(processes=None, initializer=None, initargs=()):
+        """A process pool where it can be forked, a thread pool otherwise."""
+        if os.name == 'posix':
+            return multiprocessing.Pool(processes, _init_child,
+                                        (initializer, initargs))
+        return ThreadPool(processes, initializer, initargs)
+
+    # longest wait for the next parse job before giving up on the pool
+    PARSE_TIMEOUT = 600
+
+    def _parse_job(job):
+        key, func, fname = job
+        return (key, fname) + timed_call(func, fname)
+
+    def parse_concurrently(jobs):
+        """Run (key, func, fname) parse jobs in parallel.
+
+        Yields (key, fname, result, seconds) in completion order and raises
+        ParseError as soon as any job fails, without waiting for the rest.
+        A result that cannot be sent back, or a job that takes longer than
+        PARSE_TIMEOUT, fails every file still pending.  Worker processes are
+        used where they can be forked.
+        """
+        pool = make_pool(len(jobs))
+        pending = [fname for key, func, fname in jobs]
+        try:
+            results = pool.imap_unordered(_parse_job, jobs)
+            for i in range(len(jobs)):
+                try:
+                    key, fname, ok, result, t = results.next(PARSE_TIMEOUT)
+                except Exception:
+                    raise ParseError(', '.join(pending),
+                                     traceback.format_exc())
+                pending.remove(fname)
+                if not ok:
+                    raise ParseError(fname, result)
+                yield key, fname, result, t
+        finally:
+            pool.terminate()
+
+    def as_model(mod):
+        if isinstance(mod, ColumnarModel):
+            return mod.to_model()
+        return mod
+
+    def as_columns(mod):
+        if isinstance(mod, ColumnarModel):
+            return mod
+        return ColumnarModel.from_model(mod)
+
+    def get_terms(mod, attr, width):
+        terms = getattr(mod, attr, None)
+        if terms is None or not len(terms):
+            return np.zeros((0, width), dtype=np.int64)
+        return np.asarray(terms, dtype=np.int64).reshape(-1, width)
+
+    def split_molecules(natoms, bonds):
+        """Return the first atom of every contiguous, bond-closed molecule.
+
+        A boundary between atoms k-1 and k is a molecule boundary when no
+        bond spans it, so the split is a cumulative sum over bond ranges.
+        """
+        lo = bonds.min(axis=1) + 1 if len(bonds) else np.zeros(0, dtype=int)
+        hi = bonds.max(axis=1) + 1 if len(bonds) else np.zeros(0, dtype=int)
+        cover = np.cumsum(np.bincount(lo, minlength=natoms + 1) -
+                          np.bincount(hi, minlength=natoms + 1))[:natoms]
+        return np.flatnonzero(cover == 0)
+
+    def residue_ordinals(cols):
+        """Number the residues of cols from 1, a residue starting wherever
+        the resid, insertion code, residue name, chain or segid changes."""
+        newres = np.ones(len(cols), dtype=bool)
+        newres[1:] = ((cols.resids[1:] != cols.resids[:-1]) |
+                      (cols.icodes[1:] != cols.icodes[:-1]) |
+                      (cols.resnames[1:] != cols.resnames[:-1]) |
+                      (cols.chains[1:] != cols.chains[:-1]) |
+                      (cols.segids[1:] != cols.segids[:-1]))
+        return np.cumsum(newres)
+
+    def segment_breaks(cols):
+        """Whether each atom starts a segment, that is where the segid or
+        the chain changes, so blank-segid input splits by chain."""
+        new = np.ones(len(cols), dtype=bool)
+        new[1:] = ((cols.segids[1:] != cols.segids[:-1]) |
+                   (cols.chains[1:] != cols.chains[:-1]))
+        return new
+
+    def chain_termini(cols):
+        """Whether each atom is in the first and in the last polymer
+        residue of its segment (see segment_breaks).
+
+        Polymer residues are ATOM records other than water and ions, so
+        crystal waters, ions and ligands after the TER of a chain do not
+        move its terminus.  A segment without any falls back to all its
+        residues other than water and ions.
+        """
+        n = len(cols)
+        if not n:
+            return np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)
+        resord = residue_ordinals(cols)
+        seg = np.cumsum(segment_breaks(cols)) - 1
+        nseg = seg[-1] + 1
+        solvent = residue_mask(cols, WATERS + tuple(ION_CHARGES))
+        lo = np.full(nseg, n + 1, dtype=np.int64)
+        hi = np.zeros(nseg, dtype=np.int64)
+        for mask in (~cols.hetatm & ~solvent, ~solvent):
+            # residues with any such atom, in segments still without ends
+            ok = mask & (hi[seg] == 0)
+            np.minimum.at(lo, seg[ok], resord[ok])
+            np.maximum.at(hi, seg[ok], resord[ok])
+        return resord == lo[seg], resord == hi[seg]
+
+    def row_keys(*columns):
+        """Code equal rows across parallel columns with equal integers."""
+        n = len(columns[0])
+        order = np.lexsort(columns)
+        new = np.zeros(n, dtype=bool)
+        new[:1] = True
+        for c in columns:
+            c = c[order]
+            new[1:] |= c[1:] != c[:-1]
+        keys = np.empty(n, dtype=np.int64)
+        keys[order] = np.cumsum(new) - 1
+        return keys
+
+    class GromacsTopFile:
+        """GROMACS topology writer.
+
+        Identical molecules (same atom names, types, charges, masses and
+        bonded terms) share one [ moleculetype ] and consecutive copies are
+        counted in [ molecules ].
+        """
+
+        # O-H and H-H distances (nm) of the rigid CHARMM water models
+        water_geometry = (0.09572, 0.15139)
+
+        # model attribute, atoms per term, function type, section
+        sections = (('bonds', 2, 1, 'bonds'), ('angles', 3, 5, 'angles'),
+                    ('dihedrals', 4, 9, 'dihedrals'),
+                    ('impropers', 4, 2, 'dihedrals'),
+                    ('cmaps', 5, 1, 'cmap'))
+
+        def __init__(self, fname, mode='w'):
+            self.fname = fname
+            self.mode = mode
+
+        @contextmanager
+        def open(self):
+            if hasattr(self.fname, 'write'):
+                yield self.fname
+            else:
+                with open(self.fname, self.mode) as fp:
+                    yield fp
+
+        def write(self, mod, ffinfo=None):
+            cols = as_columns(mod)
+            mod = as_model(mod)
+            natoms = len(cols)
+            terms = [self.get_terms(mod, attr, w) for attr, w, ft, sec in
+                     self.sections]
+            links = terms[0]
+            vsites = getattr(mod, 'vsites', None)
+            if vsites is not None:
+                # (site, O, H1, H2) rows, kept in the molecule of their O
+                w, k = np.nonzero(vsites.index >= 0)
+                vrows = np.column_stack((vsites.index[w, k],
+                                         vsites.frames[w]))
+                links = np.concatenate((links, vrows[:, :2]))
+                terms.append(vrows)
+            starts = split_molecules(natoms, links)
+            ends = np.append(starts[1:], natoms)
+            nmols = len(starts)
+            molid = np.repeat(np.arange(nmols), ends - starts)
+            resord = residue_ordinals(cols)
+            relres = resord - resord[starts][molid] + 1
+
+            akeys = row_keys(cols.names, cols.types, cols.resnames, relres,
+                             cols.charges, cols.masses).tolist()
+
+            # bonded terms sorted by molecule, as flat lists of
+            # molecule-relative indices
+            flat = []
+            bounds = []
+            for t in terms:
+                tmol = molid[t.min(axis=1)] if len(t) else molid[:0]
+                order = np.argsort(tmol, kind='mergesort')
+                tmol = tmol[order]
+                rel = t[order] - starts[tmol][:, None]
+                flat.append(rel.ravel().tolist())
+                bounds.append((np.searchsorted(tmol, np.arange(nmols + 1)) *
+                               t.shape[1]).tolist())
+
+            moltypes = {}
+            firsts = []
+            seq = np.empty(nmols, dtype=np.int64)
+            starts_l = starts.tolist()
+            ends_l = ends.tolist()
+            for m in range(nmols):
+                sig = (tuple(akeys[starts_l[m]:ends_l[m]]),) + tuple(
+                        tuple(f[b[m]:b[m + 1]]) for f, b in zip(flat, bounds))
+                try:
+                    seq[m] = moltypes[sig]
+                except KeyError:
+                    seq[m] = moltypes[sig] = len(firsts)
+                    firsts.append(m)
+
+            with self.open() as fp:
+                self.write_header(fp, ffinfo)
+                if vsites is not None:
+                    sites = vsites.index[vsites.index >= 0]
+                    self.write_site_types(fp, cols.strings.decode(
+                            np.unique(cols.types[sites])))
+                names = []
+                for m in firsts:
+                    name = self.moltype_name(cols, starts_l[m], ends_l[m],
+                                             names)
+                    names.append(name)
+                    self.write_moltype(fp, name, cols, starts_l[m],
+                                       ends_l[m], relres,
+                                       [f[b[m]:b[m + 1]]
+                                        for f, b in zip(flat, bounds)],
+                                       vsites)
+                fp.write('\n[ system ]\n%s\n\n[ molecules ]\n' %
+                         (ffinfo[1] if ffinfo else 'EMDY'))
+                change = np.flatnonzero(np.diff(seq)) + 1
+                run_starts = np.append(0, change)
+                counts = np.diff(np.append(run_starts, nmols))
+                for t, c in zip(seq[run_starts].tolist(), counts.tolist()):
+                    fp.write('%-16s %8d\n' % (names[t], c))
+
+        def get_terms(self, mod, attr, width):
+            if attr == 'cmaps':
+                # the two dihedrals of a cmap term share three atoms
+                return get_terms(mod, attr, 8)[:, [0, 1, 2, 3, 7]]
+            return get_terms(mod, attr, width)
+
+        def write_header(self, fp, ffinfo):
+            fp.write('; Topology written by %s %s\n' % (__program__,
+                                                        __version__))
+            if ffinfo:
+                fp.write('; Forcefield: %s\n' % ffinfo[1])
+                fp.write('#include "charmm%d.ff/forcefield.itp"\n' %
+                         ffinfo[0])
+
+        def write_site_types(self, fp, types):
+            """[ atomtypes ] of massless, chargeless virtual particles, the
+            charges being those of the [ atoms ] entries."""
+            fp.write('\n[ atomtypes ]\n'
+                     '; name  at.num  mass  charge  ptype  sigma  epsilon\n')
+            for t in types:
+                fp.write('%-8s %3d %8.4f %8.4f %2s %10.6f %10.6f\n' %
+                         (t, 0, 0.0, 0.0, 'D', 0.0, 0.0))
+
+        def moltype_name(self, cols, start, end, used):
+            s = cols.strings
+            resnames = np.unique(cols.resnames[start:end])
+            if len(resnames) == 1:
+                base = s[resnames[0]]
+            else:
+                base = s[cols.segids[start]] or 'MOL'
+            name = base
+            i = 1
+            while name in used:
+                i += 1
+                name = '%s_%d' % (base, i)
+            return name
+
+        def write_moltype(self, fp, name, cols, start, end, relres, terms,
+                          vsites=None):
+            s = cols.strings
+            write = fp.write
+            write('\n[ moleculetype ]\n; name  nrexcl\n%s  3\n' % name)
+            write('\n[ atoms ]\n')
+            rows = zip(s.decode(cols.types[start:end]),
+                       relres[start:end].tolist(),
+                       s.decode(cols.resnames[start:end]),
+                       s.decode(cols.names[start:end]),
+                       cols.charges[start:end].tolist(),
+                       cols.masses[start:end].tolist())
+            for i, (typ, resnr, resname, atname, q, m) in enumerate(rows):
+                write('%6d %10s %6d %6s %6s %6d %10.6f %10.4f\n' %
+                      (i + 1, typ, resnr, resname, atname, i + 1, q, m))
+
+            # the O, H1, H2 of a water, kept rigid by SETTLE unless
+            # FLEXIBLE is defined; 4- and 5-point sites are massless
+            water = None
+            if s[cols.resnames[start]] in WATERS:
+                heavy = np.flatnonzero(cols.masses[start:end] > 0)
+                if len(heavy) == 3:
+                    water = heavy[np.argsort(
+                            -cols.masses[start:end][heavy], kind='mergesort')]
+            if water is not None:
+                write('\n#ifdef FLEXIBLE\n')
+
+            excluded = set()
+            for (attr, w, ft, sec), idx in zip(self.sections, terms):
+                if not idx:
+                    continue
+                write('\n[ %s ]\n' % sec)
+                fmt = '%6d' * w + ' %6d\n'
+                for k in range(0, len(idx), w):
+                    write(fmt % tuple([i + 1 for i in idx[k:k + w]] + [ft]))
+                if attr in ('bonds', 'angles'):
+                    for k in range(0, len(idx), w):
+                        excluded.add((min(idx[k], idx[k + w - 1]),
+                                      max(idx[k], idx[k + w - 1])))
+                elif attr == 'dihedrals':
+                    pairs = set((min(idx[k], idx[k + 3]),
+                                 max(idx[k], idx[k + 3]))
+                                for k in range(0, len(idx), 4))
+                    pairs -= excluded
+                    if pairs:
+                        write('\n[ pairs ]\n')
+                        for i, j in sorted(pairs):
+                            write('%6d%6d %6d\n' % (i + 1, j + 1, 1))
+
+            if water is not None:
+                o, h1, h2 = (i + 1 for i in water.tolist())
+                write('\n#else\n\n[ settles ]\n%6d %6d %10.5f %10.5f\n'
+                      '\n#endif\n' % ((o, 1) + self.water_geometry))
+                write('\n[ exclusions ]\n%6d%6d%6d\n%6d%6d%6d\n%6d%6d%6d\n'
+                      % (o, h1, h2, h1, o, h2, h2, o, h1))
+
+            idx = terms[len(self.sections):]
+            if vsites is not None and idx and idx[0]:
+                self.write_vsites(fp, s.decode(cols.names[start:end]),
+                                  idx[0], vsites)
+
+        def write_vsites(self, fp, names, idx, vsites):
+            """[ virtual_sites3 ] of (site, O, H1, H2) rows, with each
+            site excluded from the rest of its water."""
+            write = fp.write
+            write('\n[ virtual_sites3 ]\n')
+            waters = {}
+            for k in range(0, len(idx), 4):
+                site, o, h1, h2 = idx[k:k + 4]
+                j = vsites.names.index(names[site])
+                atoms = (site + 1, o + 1, h1 + 1, h2 + 1)
+                if vsites.c[j]:
+                    # c is per nm in GROMACS units
+                    write('%6d%6d%6d%6d %6d %10.6f %10.6f %10.6f\n' %
+                          (atoms + (4, vsites.a[j], vsites.b[j],
+                                    10 * vsites.c[j])))
+                else:
+                    write('%6d%6d%6d%6d %6d %10.6f %10.6f\n' %
+                          (atoms + (1, vsites.a[j], vsites.b[j])))
+                waters.setdefault(atoms[1:], []).append(atoms[0])
+            write('\n[ exclusions ]\n')
+            for hosts, sites in sorted(waters.items()):
+                for site in sites:
+                    others = [i for i in hosts + tuple(sites) if i != site]
+                    write(' '.join('%6d' % i for i in [site] + others) +
+                          '\n')
+
+    def residue_mask(cols, resnames):
+        table = np.zeros(len(cols.strings), dtype=bool)
+        index = cols.strings.index
+        table[[index[r] for r in resnames if r in index]] = True
+        return table[cols.resnames]
+
+    def vdw_radii(cols):
+        table = np.array([VDW_RADII.get(s[:1], 1.7)
+                          for s in cols.strings.strings])
+        return table[cols.names]
+
+    def box_volume(cols):
+        """Volume of the periodic box, or of the bounding box of the atoms."""
+        box = cols.box
+        if box is not None and len(box) >= 3:
+            a, b, c = box[:3]
+            if len(box) < 6:
+                return a * b * c
+            ca, cb, cc = np.cos(np.radians(box[3:6]))
+            return a * b * c * np.sqrt(1 - ca * ca - cb * cb - cc * cc +
+                                       2 * ca * cb * cc)
+        if not len(cols):
+            return 0.0
+        return np.prod(cols.coords.max(axis=0) - cols.coords.min(axis=0))
+
+    def box_vectors(box):
+        """Cell vectors (3 x 3, one per row) of a (a, b, c, alpha, beta,
+        gamma) box, with a along x and b in the xy plane."""
+        a, b, c = box[:3]
+        angles = box[3:6] if len(box) >= 6 else (90.0, 90.0, 90.0)
+        ca, cb, cg = np.cos(np.radians(angles))
+        sg = np.sin(np.radians(angles[2]))
+        cy = (ca - cb * cg) / sg
+        return np.array([[a, 0.0, 0.0], [b * cg, b * sg, 0.0],
+                         [c * cb, c * cy,
+                          c * np.sqrt(max(1 - cb * cb - cy * cy, 0.0))]])
+
+    def image_shifts(box):
+        """Translations to a point and its 26 nearest periodic images, the
+        point itself first; only the point without a box."""
+        if box is None or len(box) < 3:
+            return np.zeros((1, 3))
+        g = np.array([0, -1, 1])
+        n = np.array(np.meshgrid(g, g, g, indexing='ij')).reshape(3, -1).T
+        return n.dot(box_vectors(box))
+
+    class OccupancyGrid:
+        """Boolean voxel grid for fast overlap tests.
+
+        The grid covers lo..hi plus pad on every side.  Spheres are
+        stamped with a precomputed stencil of voxel offsets per radius, so
+        stamping and testing any number of points is one indexing pass.
+        """
+
+        def __init__(self, lo, hi, spacing=0.5, pad=0.0):
+            self.spacing = spacing
+            self.origin = np.asarray(lo, dtype=float) - pad - spacing
+            self.dims = np.ceil((np.asarray(hi) + pad + spacing -
+                                 self.origin) / spacing).astype(np.int64) + 1
+            self.strides = np.array([self.dims[1] * self.dims[2],
+                                     self.dims[2], 1])
+            self.occupied = np.zeros(np.prod(self.dims), dtype=bool)
+            self.stencils = {}
+
+        def voxels(self, coords):
+            ijk = np.floor((coords - self.origin) /
+                           self.spacing).astype(np.int64)
+            np.clip(ijk, 0, self.dims - 1, out=ijk)
+            return ijk.dot(self.strides)
+
+        def stencil(self, r):
+            try:
+                return self.stencils[r]
+            except KeyError:
+                n = int(np.ceil(r / self.spacing))
+                g = np.arange(-n, n + 1)
+                off = np.array(np.meshgrid(g, g, g, indexing='ij'))
+                off = off.reshape(3, -1).T
+                off = off[((off * self.spacing)**2).sum(axis=1) <= r * r]
+                off = self.stencils[r] = off.dot(self.strides)
+                return off
+
+        def stamp(self, coords, radii):
+            """Mark the spheres of radii (an array or one radius)."""
+            radii = np.zeros(len(coords)) + radii
+            for r in np.unique(radii):
+                off = self.stencil(r)
+                lin = self.voxels(coords[radii == r])
+                for i in range(0, len(lin), 65536):
+                    idx = (lin[i:i + 65536, None] + off).ravel()
+                    np.clip(idx, 0, len(self.occupied) - 1, out=idx)
+                    self.occupied[idx] = True
+
+        def hits(self, coords):
+            """Whether each point falls in a marked voxel.  Points off
+            the grid are free, nothing is marked there."""
+            ijk = np.floor((coords - self.origin) /
+                           self.spacing).astype(np.int64)
+            inside = ((ijk >= 0) & (ijk < self.dims)).all(axis=1)
+            hit = np.zeros(len(coords), dtype=bool)
+            hit[inside] = self.occupied[ijk[inside].dot(self.strides)]
+            return hit
+
+    def excluded_volume(coords, radii, spacing=0.5):
+        """Volume covered by atomic spheres, counted on a voxel grid."""
+        if not len(coords):
+            return 0.0
+        grid = OccupancyGrid(coords.min(axis=0), coords.max(axis=0),
+                             spacing, radii.max())
+        grid.stamp(coords, radii)
+        return np.count_nonzero(grid.occupied) * spacing**3
+
+    def solvent_volume(cols):
+        """Box volume minus the volume excluded by the solute, in A^3."""
+        solute = ~residue_mask(cols, WATERS + tuple(ION_CHARGES))
+        return max(box_volume(cols) -
+                   excluded_volume(cols.coords[solute],
+                                   vdw_radii(cols)[solute]), 0.0)
+
+    def estimate_ions(cols, cation, anion, saltcon):
+        """Numbers of ions for a salt concentration plus neutralization."""
+        volume = solvent_volume(cols)
+        qcat = ION_CHARGES[cation]
+        qani = -ION_CHARGES[anion]
+        nsalt = int(round(saltcon * volume * 1e-27 * AVOGADRO))
+        ncat = nsalt
+        nani = nsalt * qcat // qani
+        q = int(round(cols.total_charge()))
+        if q < 0:
+            ncat += -(q // qcat)
+        elif q > 0:
+            nani += -(-q // qani)
+        return ncat, nani, volume
+
+    def match_coords(coords, ref, decimals=3):
+        """For each row of coords, the index of the same position in ref.
+
+        Positions are compared after rounding; -1 marks no match.
+        """
+        both = np.round(np.concatenate([ref, coords]) * 10**decimals)
+        valid = np.isfinite(both).all(axis=1)
+        both[~valid] = 0
+        keys = row_keys(both[:, 0], both[:, 1], both[:, 2])
+        n = len(ref)
+        pos = np.empty(keys.max() + 1 if len(keys) else 0, dtype=np.int64)
+        pos.fill(-1)
+        pos[keys[:n][::-1]] = np.arange(n)[::-1]
+        src = pos[keys[n:]]
+        src[~valid[n:]] = -1
+        return src
+
+    _ensemble = {}
+
+    def _init_ensemble(built, top, prm, src):
+        _ensemble['built'] = built
+        _ensemble['top'] = top
+        _ensemble['prm'] = prm
+        _ensemble['src'] = src
+
+    def _complete_conformer(coords):
+        with child_output() as log:
+            mod = copy.deepcopy(_ensemble['built'])
+            src = _ensemble['src']
+            mapped = src >= 0
+            mod.coords[mapped] = coords[src[mapped]]
+            mod = complete_coords(mod, _ensemble['top'], _ensemble['prm'])
+        return np.array(mod.coords), log.getvalue()
+
+    def add_atoms_ensemble(mod, conformers, top, prm):
+        """Build the topology of mod once and complete every conformer.
+
+        Atoms of the built model are matched to the input atoms by their
+        position in the first model, so the coordinates of any other
+        model can be dropped in before the missing atoms are placed.  The
+        first model is completed here while a pool does the others.
+        Returns the completed first model and the coordinates of all.
+        """
+        built = build_topology(mod, top)
+        src = match_coords(np.asarray(built.coords), np.asarray(conformers[0]))
+        pool = make_pool(initializer=_init_ensemble,
+                         initargs=(built, top, prm, src))
+        try:
+            others = pool.map_async(_complete_conformer, conformers[1:])
+            first = complete_coords(copy.deepcopy(built), top, prm)
+            ensemble = [np.array(first.coords)]
+            for coords, log in others.get():
+                sys.stdout.write(log)
+                ensemble.append(coords)
+        finally:
+            pool.terminate()
+        return first, ensemble
+
+    TERMS = (('bonds', 2), ('angles', 3), ('dihedrals', 4),
+             ('impropers', 4), ('cmaps', 8))
+
+    def empty_like(mod):
+        new = copy.copy(mod)
+        new.atoms = []
+        new.coords = np.zeros((0, 3))
+        for attr, w in TERMS:
+            if hasattr(mod, attr):
+                setattr(new, attr, [])
+        return new
+
+    def append_atoms(mod, atoms, coords, terms):
+        """Append atoms and their 0-based terms (by attribute) to mod."""
+        n = len(mod.atoms)
+        mod.atoms.extend(atoms)
+        mod.coords = np.concatenate([np.asarray(mod.coords), coords])
+        for attr, t in terms.items():
+            if len(t):
+                getattr(mod, attr).extend(map(tuple, (t + n).tolist()))
+
+    def permute_atoms(mod, order):
+        """Copy of mod with its atoms in order, renumbering the terms."""
+        new = empty_like(mod)
+        new.atoms = [mod.atoms[i] for i in order.tolist()]
+        new.coords = np.asarray(mod.coords)[order]
+        where = np.empty(len(order), dtype=np.int64)
+        where[order] = np.arange(len(order))
+        for attr, w in TERMS:
+            if hasattr(mod, attr):
+                setattr(new, attr, list(map(
+                        tuple, where[get_terms(mod, attr, w)].tolist())))
+        return new
+
+    def residue_sizes(atoms):
+        """Atom count of each run of atoms sharing resid, insertion code,
+        resname, chain and segment name, the residues of a built model."""
+        keys = [(a.resid, getattr(a, 'icode', '') or '', a.resname,
+                 getattr(a, 'chain', '') or '', a.segname) for a in atoms]
+        if not keys:
+            return np.zeros(0, dtype=np.int64)
+        new = [True] + [k != p for k, p in zip(keys[1:], keys[:-1])]
+        starts = np.flatnonzero(new)
+        return np.diff(np.append(starts, len(keys)))
+
+    class ResidueTemplateCache:
+        """Built residues keyed by residue name, atom names and patches.
+
+        Residues that are molecules on their own (water, ions) are built
+        once per key with CharmmTopBuilder and then stamped out by
+        offsetting the template's term indices.  The patch part of the key
+        is the residue's position in its segment (first, last), which is
+        what decides the default terminal patches.
+        """
+
+        resnames = WATERS + tuple(ION_CHARGES)
+
+        def __init__(self, top):
+            self.top = top
+            self.templates = {}
+            self.hits = 0
+            self.misses = 0
+            self.build_time = 0.0
+
+        def get(self, key, cols, start, end):
+            try:
+                tmpl = self.templates[key]
+            except KeyError:
+                t0 = time.time()
+                mod = CharmmTopBuilder(cols.take(slice(start, end)).to_model(),
+                                       self.top).build()
+                src = match_coords(np.asarray(mod.coords),
+                                   cols.coords[start:end])
+                terms = [get_terms(mod, attr, w) for attr, w in TERMS]
+                tmpl = self.templates[key] = (mod, src, terms)
+                self.build_time += time.time() - t0
+                self.misses += 1
+                return tmpl
+            self.hits += 1
+            return tmpl
+
+        def report(self):
+            n = self.hits + self.misses
+            if not n:
+                return
+            saved = self.hits * self.build_time / max(self.misses, 1)
+            print('Residue templates: %d hits, %d misses (%.1f%% hit rate), '
+                  'about %.1f s of building saved' %
+                  (self.hits, self.misses, 100.0 * self.hits / n, saved))
+
+        def stamp(self, mod, cols, key, starts):
+            """Append a copy of the template key for each residue start."""
+            tmpl, src, terms = self.templates[key]
+            k = len(starts)
+            natoms = len(tmpl.atoms)
+            coords = np.repeat(np.asarray(tmpl.coords)[None], k, axis=0)
+            mapped = src >= 0
+            coords[:, mapped] = cols.coords[starts[:, None] + src[mapped]]
+            segids = cols.strings.decode(cols.segids[starts])
+            chains = cols.strings.decode(cols.chains[starts])
+            icodes = cols.strings.decode(cols.icodes[starts])
+            atoms = []
+            for resid, icode, segid, chain in zip(
+                    cols.resids[starts].tolist(), icodes, segids, chains):
+                for a in tmpl.atoms:
+                    a = copy.copy(a)
+                    a.resid = resid
+                    a.icode = icode
+                    a.segname = segid
+                    a.chain = chain
+                    atoms.append(a)
+            offsets = (np.arange(k) * natoms)[:, None, None]
+            append_atoms(mod, atoms, coords.reshape(-1, 3),
+                         dict((attr, (t[None] + offsets).reshape(-1, w))
+                              for (attr, w), t in zip(TERMS, terms)))
+
+    def build_topology(mod, top, prm=None, parallel=False, cutoff=3.0):
+        """CharmmTopBuilder.build() with standalone residues templated.
+
+        The other residues are built together and the templated ones
+        stamped after them, then every residue is moved back to its input
+        position.  With parallel, the other residues are built and
+        completed segment by segment in a pool, see build_segments.
+        """
+        cols = as_columns(mod)
+        cache = ResidueTemplateCache(top)
+        standalone = residue_mask(cols, cache.resnames)
+        if not standalone.any():
+            if parallel:
+                return build_segments(cols, top, prm, cutoff)
+            return CharmmTopBuilder(as_model(mod), top).build()
+
+        resord = residue_ordinals(cols)
+        starts = np.flatnonzero(np.diff(np.append(0, resord)))
+        ends = np.append(starts[1:], len(cols))
+        first = segment_breaks(cols)[starts]
+        last = np.append(first[1:], True)
+        names = cols.names.tolist()
+        resnames = cols.resnames.tolist()
+
+        # runs of consecutive residues sharing a template key
+        runs = []
+        for i in np.flatnonzero(standalone[starts]).tolist():
+            s, e = starts[i], ends[i]
+            key = (resnames[s], tuple(names[s:e]), first[i], last[i])
+            if runs and runs[-1][0] == key:
+                runs[-1][1].append(s)
+            else:
+                runs.append((key, [s]))
+
+        rest = np.flatnonzero(~standalone)
+        built = None
+        if len(rest) and parallel:
+            built = build_segments(cols.take(rest), top, prm, cutoff)
+        elif len(rest):
+            built = CharmmTopBuilder(cols.take(rest).to_model(), top).build()
+        nrest = len(built.atoms) if built is not None else 0
+        stamped = []
+        for key, group in runs:
+            s = group[0]
+            tmpl = cache.get(key, cols, s, s + len(key[1]))
+            cache.hits += len(group) - 1
+            if built is None:
+                built = empty_like(tmpl[0])
+            cache.stamp(built, cols, key, np.array(group))
+            stamped.extend([len(tmpl[0].atoms)] * len(group))
+        cache.report()
+        return input_order(built, standalone[starts], nrest, stamped)
+
+    def input_order(built, standalone, nrest, stamped):
+        """Move the residues of built back to input order.
+
+        built holds nrest atoms of the other residues followed by the
+        templated residues of stamped atoms each, and standalone flags the
+        input residues that were templated.
+        """
+        sizes = np.zeros(len(standalone), dtype=np.int64)
+        rest = residue_sizes(built.atoms[:nrest])
+        if len(rest) != (~standalone).sum():
+            print('Built residues do not match the input, '
+                  'keeping templated residues last')
+            return built
+        sizes[~standalone] = rest
+        sizes[standalone] = stamped
+        # where each residue starts in built and in input order
+        src = np.append(0, np.cumsum(np.append(sizes[~standalone],
+                                               sizes[standalone])))[:-1]
+        src = src[np.argsort(np.append(np.flatnonzero(~standalone),
+                                       np.flatnonzero(standalone)),
+                             kind='mergesort')]
+        dst = np.cumsum(sizes) - sizes
+        if (src == dst).all():
+            return built
+        order = (np.arange(sizes.sum()) -
+                 np.repeat(dst - src, sizes))
+        return permute_atoms(built, order)
+
+    def segment_groups(cols, cutoff=3.0):
+        """Start and end atom of runs of segments to build together.
+
+        Segments are split where nothing crosses: segments holding two
+        CYS SG atoms within cutoff of each other, and all segments between
+        them, stay in one run so the builder sees the disulfide exactly as
+        in a serial build.
+        """
+        n = len(cols)
+        breaks = segment_breaks(cols)
+        starts = np.flatnonzero(breaks)
+        segord = np.cumsum(breaks) - 1
+        nseg = len(starts)
+        # a cut after segment i is allowed unless a link spans it
+        cover = np.zeros(nseg + 1, dtype=np.int64)
+        sg = np.flatnonzero(residue_mask(cols, ('CYS',)) &
+                            (cols.names == cols.strings.index.get('SG', -1)))
+        xyz = cols.coords[sg]
+        for k in range(len(sg) - 1):
+            d2 = ((xyz[k + 1:] - xyz[k])**2).sum(axis=1)
+            for j in sg[k + 1:][d2 < cutoff * cutoff]:
+                a, b = sorted((segord[sg[k]], segord[j]))
+                if a != b:
+                    cover[a + 1] += 1
+                    cover[b + 1] -= 1
+        cuts = np.flatnonzero(np.cumsum(cover)[1:nseg] == 0) + 1
+        bounds = np.append(np.append(0, starts[cuts]), n)
+        return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+    _segments = {}
+
+    def _init_segments(cols, top, prm):
+        _segments['cols'] = cols
+        _segments['top'] = top
+        _segments['prm'] = prm
+
+    def _build_segment(bounds):
+        with child_output() as log:
+            cols = _segments['cols'].take(slice(*bounds))
+            built = CharmmTopBuilder(cols.to_model(),
+                                     _segments['top']).build()
+            built = complete_coords(built, _segments['top'],
+                                    _segments['prm'])
+        return built, log.getvalue()
+
+    def merge_models(parts):
+        """Concatenate built models, renumbering their term indices."""
+        merged = empty_like(parts[0])
+        for p in parts:
+            append_atoms(merged, p.atoms, np.asarray(p.coords),
+                         dict((attr, get_terms(p, attr, w))
+                              for attr, w in TERMS if hasattr(merged, attr)))
+        return merged
+
+    def copy_segnames(segs, k, used):
+        """Map each segment name to an unused one for assembly copy k."""
+        names = {}
+        serial = 0
+        tag = str(k)
+        for seg in sorted(set(segs)):
+            name = seg[:max(4 - len(tag), 1)] + tag
+            while name in used:
+                serial += 1
+                name = 'X%03d' % serial
+            used.add(name)
+            names[seg] = name
+        return names
+
+    def replicate_model(mod, groups):
+        """Biological assembly of a built model.
+
+        Each (chains, matrices) group of parse_biomt copies the atoms of its
+        chains once per matrix.  The coordinates of all copies come from a
+        single matrix product and the terms of the built copy are offset,
+        not rebuilt.  Copies after the first get new segment names.
+        """
+        n = len(mod.atoms)
+        coords = np.asarray(mod.coords)
+        chains = [getattr(a, 'chain', '') or '' for a in mod.atoms]
+        segs = [getattr(a, 'segname', '') or '' for a in mod.atoms]
+        used = set(segs)
+        terms = [(attr, get_terms(mod, attr, w))
+                 for attr, w in TERMS if hasattr(mod, attr)]
+        merged = empty_like(mod)
+        k = 0
+        for sel, mats in groups:
+            if sel is None or not any(chains):
+                idx = np.arange(n)
+            else:
+                idx = np.flatnonzero([c in sel for c in chains])
+            if not len(idx):
+                continue
+            remap = np.full(n, -1, dtype=np.int64)
+            remap[idx] = np.arange(len(idx))
+            m = len(mats)
+            xyz = (np.einsum('mij,nj->mni', mats[:, :, :3], coords[idx]) +
+                   mats[:, None, :, 3])
+            offsets = (np.arange(m) * len(idx))[:, None, None]
+            sub = {}
+            for attr, t in terms:
+                t = remap[t]
+                t = t[(t >= 0).all(axis=1)]
+                sub[attr] = (t[None] + offsets).reshape(-1, t.shape[1])
+            atoms = []
+            for j in range(m):
+                if not k:
+                    atoms.extend(mod.atoms[i] for i in idx)
+                else:
+                    names = copy_segnames([segs[i] for i in idx], k, used)
+                    for i in idx:
+                        a = copy.copy(mod.atoms[i])
+                        a.segname = names[segs[i]]
+                        atoms.append(a)
+                k += 1
+            append_atoms(merged, atoms, xyz.reshape(-1, 3), sub)
+        return merged
+
+    def build_segments(cols, top, prm, cutoff=3.0):
+        """Build and complete the segments of cols in a pool and merge
+        them in input order."""
+        groups = segment_groups(cols, cutoff)
+        print('Building %d segment groups in parallel' % len(groups))
+        if len(groups) == 1:
+            _init_segments(cols, top, prm)
+            results = [_build_segment(groups[0])]
+        else:
+            pool = make_pool(initializer=_init_segments,
+                             initargs=(cols, top, prm))
+            try:
+                results = pool.map(_build_segment, groups)
+            finally:
+                pool.terminate()
+        for part, log in results:
+            sys.stdout.write(log)
+        if len(results) == 1:
+            return results[0][0]
+        return merge_models([part for part, log in results])
+
+    def residue_ics(top, resname):
+        res = getattr(top, 'residues', {}).get(resname)
+        return getattr(res, 'ics', None) or []
+
+    def place_atoms(a, b, c, r, theta, phi):
+        """Positions d with |cd| = r, angle bcd = theta and dihedral
+        abcd = phi (degrees), for every row of a, b and c."""
+        theta = np.radians(theta)
+        phi = np.radians(phi)
+        bc = c - b
+        bc /= np.sqrt((bc * bc).sum(axis=1))[:, None]
+        n = np.cross(b - a, bc)
+        n /= np.sqrt((n * n).sum(axis=1))[:, None]
+        m = np.cross(n, bc)
+        return c + ((-r * np.cos(theta))[:, None] * bc +
+                    (r * np.sin(theta) * np.cos(phi))[:, None] * m +
+                    (r * np.sin(theta) * np.sin(phi))[:, None] * n)
+
+    def ic_table(cols, top):
+        """Atom indices (n x 4), values (n x 5) and improper flags of every
+        residue IC entry resolved against the model."""
+        nstr = len(cols.strings)
+        resord = residue_ordinals(cols) - 1
+        starts = np.flatnonzero(np.diff(np.append(-1, resord)))
+        nres = len(starts)
+        segids = cols.segids[starts]
+        keys = resord * nstr + cols.names
+        order = np.argsort(keys, kind='mergesort')
+        skeys = keys[order]
+
+        def lookup(res, name):
+            k = res * nstr + name
+            pos = np.minimum(np.searchsorted(skeys, k), len(skeys) - 1)
+            return np.where(skeys[pos] == k, order[pos], -1)
+
+        index = cols.strings.index
+        resnames = cols.resnames[starts]
+        atoms, values, impropers = [], [], []
+        for code in np.unique(resnames).tolist():
+            ics = residue_ics(top, cols.strings[code])
+            res = np.flatnonzero(resnames == code)
+            for ic in ics:
+                idx = []
+                for name in ic[:4]:
+                    name = name.lstrip('*')
+                    shift = {'-': -1, '+': 1}.get(name[:1], 0)
+                    name = name.lstrip('-+')
+                    if name not in index:
+                        break
+                    other = np.clip(res + shift, 0, nres - 1)
+                    found = lookup(other, index[name])
+                    found[(other != res + shift) |
+                          (segids[other] != segids[res])] = -1
+                    idx.append(found)
+                else:
+                    idx = np.array(idx).T
+                    ok = (idx >= 0).all(axis=1)
+                    atoms.append(idx[ok])
+                    values.append(np.tile(np.asarray(ic[4:9], dtype=float),
+                                          (ok.sum(), 1)))
+                    impropers.append(np.repeat(ic[2].startswith('*'),
+                                               ok.sum()))
+        if not atoms:
+            return (np.zeros((0, 4), dtype=np.int64), np.zeros((0, 5)),
+                    np.zeros(0, dtype=bool))
+        return (np.concatenate(atoms), np.concatenate(values),
+                np.concatenate(impropers))
+
+    def place_by_ic(mod, top):
+        """Place atoms with non-finite coordinates from the residue ICs.
+
+        Atoms are placed level by level: every IC entry whose three
+        reference atoms are known places its fourth atom (or its first,
+        working backwards), all in one array operation per level.
+        Returns the numbers of atoms placed and of levels.
+        """
+        cols = as_columns(mod)
+        idx, val, imp = ic_table(cols, top)
+        coords = np.array(mod.coords, dtype=float)
+        known = np.isfinite(coords).all(axis=1)
+        i, j, k, l = idx.T
+        rij, tijk, phi, tjkl, rkl = val.T
+        forward = (rkl > 0) & (tjkl > 0)
+        backward = (rij > 0) & (tijk > 0)
+        # references (a, b, c), distance, angle and dihedral per direction;
+        # an improper I J *K L has I bonded to K rather than to J
+        fwd = (i, j, k, rkl, tjkl, phi)
+        bwd = (l, np.where(imp, j, k), np.where(imp, k, j), rij, tijk,
+               np.where(imp, -phi, phi))
+        nplaced = nlevels = 0
+        while True:
+            cand_f = forward & ~known[l] & known[i] & known[j] & known[k]
+            cand_b = backward & ~known[i] & known[j] & known[k] & known[l]
+            target = np.concatenate([l[cand_f], i[cand_b]])
+            if not len(target):
+                break
+            refs = [np.concatenate([f[cand_f], b[cand_b]])
+                    for f, b in zip(fwd, bwd)]
+            target, first = np.unique(target, return_index=True)
+            a, b, c, r, theta, dihed = [x[first] for x in refs]
+            coords[target] = place_atoms(coords[a], coords[b], coords[c],
+                                         r, theta, dihed)
+            known[target] = True
+            nplaced += len(target)
+            nlevels += 1
+        mod.coords[:] = coords
+        return nplaced, nlevels
+
+    def complete_coords(mod, top, prm):
+        """Fill in missing atoms by IC placement, falling back to
+        CharmmCoordBuilder for anything the ICs cannot reach."""
+        if np.isfinite(np.asarray(mod.coords)).all():
+            return mod
+        nplaced, nlevels = place_by_ic(mod, top)
+        print('Placed %d atoms from ICs in %d levels' % (nplaced, nlevels))
+        if not np.isfinite(np.asarray(mod.coords)).all():
+            mod = CharmmCoordBuilder(mod, prm).complete_coords()
         return mod
 
+    def add_atoms(mod, top, prm, parallel=False, cutoff=3.0):
+        # segments built in parallel come back completed, so this only
+        # fills in what is still missing, such as templated residues
+        mod = build_topology(mod, top, prm, parallel, cutoff)
+        return complete_coords(mod, top, prm)
+
+    def view_pdb(cols, objname=None):
+        """Load cols into PyMOL through a temporary file."""
+        fd, path = tempfile.mkstemp(suffix='.pdb')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                cols.write_pdb(fp)
+            if objname is not None:
+                cmd.load(path, objname, format='pdb')
+        finally:
+            os.remove(path)
+
     def add_solvents(mod, solvent, segname, shape, pad, cut):
+        mod = as_model(mod)
         solvater = Solvater(mod, solvent=solvent, segname=segname)
 
         if shape == _CUBOID:
@@ -1263,8 +3615,184 @@ if _HAS_LIB:
             mod = solvater.as_rhombic_dodecahedron(pad=pad, cut=cut)
         return mod
 
+    def parse_cosolvents(text):
+        """[(pdb file, molarity)] from 'ipa.pdb 0.5, acem.pdb 0.25'."""
+        species = []
+        for item in text.split(','):
+            if not item.strip():
+                continue
+            fname, conc = item.rsplit(None, 1)
+            species.append((fname.strip(), float(conc)))
+        return species
+
+    def random_rotations(n):
+        """n uniformly distributed rotation matrices (n x 3 x 3)."""
+        u1, u2, u3 = np.random.random((3, n))
+        w = np.sqrt(1 - u1) * np.sin(2 * np.pi * u2)
+        x = np.sqrt(1 - u1) * np.cos(2 * np.pi * u2)
+        y = np.sqrt(u1) * np.sin(2 * np.pi * u3)
+        z = np.sqrt(u1) * np.cos(2 * np.pi * u3)
+        return np.array([
+                [1 - 2 * (y * y + z * z), 2 * (x * y - z * w),
+                 2 * (x * z + y * w)],
+                [2 * (x * y + z * w), 1 - 2 * (x * x + z * z),
+                 2 * (y * z - x * w)],
+                [2 * (x * z - y * w), 2 * (y * z + x * w),
+                 1 - 2 * (x * x + y * y)]]).transpose(2, 0, 1)
+
+    def insert_molecules(grid, mol, n, sites, shifts, cut, batch=256):
+        """Coordinates (n x natoms x 3) of n randomly placed copies of
+        mol that do not overlap anything marked in grid.
+
+        Copies are centred on random sites, the water positions, which
+        keeps them inside the cell whatever its shape.  Every copy is also
+        tested shifted by shifts (see image_shifts), so nothing overlaps
+        across the periodic boundary either.  Whole batches of random poses
+        are tested against the grid at once; each accepted copy is stamped
+        before the next is checked.
+        """
+        ref = mol - mol.mean(axis=0)
+        placed = []
+        tries = 0
+
+        def free(xyz):
+            images = xyz[:, None] + shifts[None, :, None]
+            return ~grid.hits(images.reshape(-1, 3)).reshape(
+                    len(xyz), -1).any(axis=1)
+
+        while len(placed) < n and tries < 1000 * n and len(sites):
+            k = min(batch, 4 * (n - len(placed)))
+            tries += k
+            centers = sites[np.random.randint(len(sites), size=k)]
+            xyz = (np.einsum('kij,aj->kai', random_rotations(k), ref) +
+                   centers[:, None])
+            for x in xyz[free(xyz)]:
+                if not free(x[None])[0]:
+                    continue
+                grid.stamp(x, cut)
+                placed.append(x)
+                if len(placed) == n:
+                    break
+        return np.array(placed).reshape(len(placed), len(mol), 3)
+
+    def near_any(points, centers, cutoff):
+        """Whether each point lies within cutoff of any center.
+
+        Centers are sorted into cubic cells of size cutoff, and every
+        point is compared with the centers of its 27 neighbouring cells,
+        one neighbour offset at a time for all points.
+        """
+        near = np.zeros(len(points), dtype=bool)
+        if not len(points) or not len(centers):
+            return near
+        lo = np.minimum(points.min(axis=0), centers.min(axis=0))
+        pc = np.floor((points - lo) / cutoff).astype(np.int64) + 1
+        cc = np.floor((centers - lo) / cutoff).astype(np.int64) + 1
+        dims = np.maximum(pc.max(axis=0), cc.max(axis=0)) + 2
+        ckey = (cc[:, 0] * dims[1] + cc[:, 1]) * dims[2] + cc[:, 2]
+        order = np.argsort(ckey)
+        ckey = ckey[order]
+        centers = centers[order]
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    key = (((pc[:, 0] + dx) * dims[1] + pc[:, 1] + dy) *
+                           dims[2] + pc[:, 2] + dz)
+                    start = np.searchsorted(ckey, key, 'left')
+                    count = np.searchsorted(ckey, key, 'right') - start
+                    has = np.flatnonzero(count)
+                    if not len(has):
+                        continue
+                    count = count[has]
+                    pi = np.repeat(has, count)
+                    ci = (np.repeat(start[has] - np.cumsum(count) + count,
+                                    count) + np.arange(len(pi)))
+                    d2 = ((points[pi] - centers[ci])**2).sum(axis=1)
+                    near[pi[d2 < cutoff * cutoff]] = True
+        return near
+
+    def drop_atoms(mod, drop):
+        """Copy of mod without the atoms in the mask drop, renumbering
+        the terms of the remaining atoms."""
+        keep = ~drop
+        index = np.cumsum(keep) - 1
+        new = empty_like(mod)
+        new.atoms = [a for a, k in zip(mod.atoms, keep.tolist()) if k]
+        new.coords = np.asarray(mod.coords)[keep]
+        for attr, w in TERMS:
+            if hasattr(mod, attr):
+                t = get_terms(mod, attr, w)
+                t = t[keep[t].all(axis=1)]
+                setattr(new, attr, list(map(tuple, index[t].tolist())))
+        return new
+
+    def add_cosolvents(mod, top, species, cut):
+        """Insert cosolvent molecules into a solvated model.
+
+        species is [(pdb file of one molecule, molarity)].  Molecules are
+        placed at random where an occupancy grid of the non-water atoms
+        has room, the waters within cut of them are removed in one pass,
+        and their topology is stamped from a residue template.
+        """
+        cols = as_columns(mod)
+        mod = as_model(mod)
+        volume = solvent_volume(cols)
+        water = residue_mask(cols, WATERS)
+        lo = cols.coords.min(axis=0)
+        hi = cols.coords.max(axis=0)
+        # widened by a voxel diagonal so no pair closer than cut is missed
+        reach = cut + 0.5 * np.sqrt(3)
+        grid = OccupancyGrid(lo, hi, 0.5, reach)
+        grid.stamp(cols.coords[~water], reach)
+        # first atom of every water, where the solvent fills the cell
+        resord = residue_ordinals(cols)
+        wfirst = water & np.append(True, resord[1:] != resord[:-1])
+        sites = cols.coords[wfirst]
+        shifts = image_shifts(cols.box)
+        if cols.box is None:
+            print('No periodic box, images are not checked')
+
+        cache = ResidueTemplateCache(top)
+        inserted = []
+        for fname, conc in species:
+            mol = read_pdb(fname)
+            resname = mol.strings.decode(mol.resnames[:1])[0]
+            n = int(round(conc * volume * 1e-27 * AVOGADRO))
+            xyz = insert_molecules(grid, mol.coords, n, sites, shifts,
+                                   reach)
+            print('Inserted %d of %d %s molecules' % (len(xyz), n, resname))
+            if not len(xyz):
+                continue
+            key = (resname, tuple(mol.names.tolist()), True, True)
+            tmpl, src, terms = cache.get(key, mol, 0, len(mol))
+            if (src < 0).any():
+                raise ValueError('%s lacks atoms of %s' % (fname, resname))
+            copies = mol.take(np.tile(np.arange(len(mol)), len(xyz)))
+            copies.coords = xyz.reshape(-1, 3)
+            copies.resids = np.repeat(np.arange(1, len(xyz) + 1),
+                                      len(mol)).astype(np.int32)
+            copies.segids[:] = mol.strings.code(resname[:4])
+            inserted.append((copies, key, np.arange(len(xyz)) * len(mol)))
+
+        if not inserted:
+            return mod
+        # waters within cut of any inserted atom or its periodic images
+        displaced = np.zeros(resord[-1] + 1, dtype=bool)
+        xyz = np.concatenate([c.coords for c, k, s in inserted])
+        near = near_any(cols.coords[water],
+                        (xyz[None] + shifts[:, None]).reshape(-1, 3), cut)
+        displaced[resord[water][near]] = True
+        drop = displaced[resord] & water
+        print('Removed %d displaced water molecules' %
+              np.count_nonzero(displaced))
+        mod = drop_atoms(mod, drop)
+        for copies, key, starts in inserted:
+            cache.stamp(mod, copies, key, starts)
+        return mod
+
     def add_ions(mod, cation, ncations, anion, nanions, saltcon, ionsol,
                  ionion, volume, segname, method):
+        mod = as_model(mod)
         ionizer = Ionizer(mod, cation=cation, ncations=ncations, anion=anion,
                           nanions=nanions, saltcon=saltcon, ionsol=ionsol,
                           ionion=ionion, volume=volume, segname=segname)
@@ -1275,30 +3803,962 @@ if _HAS_LIB:
             mod = ionizer.by_potential()
         return mod
 
-    def save_files(mod, prm, topfmt, topfile, crdfmt, crdfile, ffinfo):
-        if topfmt == 'NAMD psf':
-            PsfFile(topfile, 'w').write(mod)
-        elif topfmt == 'AMBER prmtop':
-            PrmtopFile(topfile, 'w').write(mod, prm, 1, None, chamber=False)
-        elif topfmt == 'CHAMBER prmtop':
-            PrmtopFile(topfile, 'w').write(mod, prm, 1, ffinfo, chamber=True)
-        elif topfmt == 'GROMACS top':
-            pass
-        else:
-            raise ValueError('Unsupported topology format' % topfmt)
-
-        if crdfmt == 'pdb':
-            PdbFile(crdfile, 'w').write(mod)
-        elif crdfmt == 'NAMD bin':
-            NamdBinFile(crdfile, 'w').write(mod.coords)
-        elif crdfmt == 'AMBER inpcrd':
-            AmberTxtRstFile(crdfile, 'w').write(mod.coords)
-        elif crdfmt == 'GROMACS g96':
-            G96File(crdfile, 'w').write(mod)
-        elif crdfmt == 'GROMACS gro':
-            GroFile(crdfile, 'w').write(mod)
+    # parameter tables of CharmmPrmFile and the number of types per key
+    PRM_KINDS = (('bonds', 2), ('angles', 3), ('dihedrals', 4),
+                 ('impropers', 4), ('cmaps', 8))
+
+    def canonical_key(kind, key):
+        if kind == 'cmaps':
+            return key
+        return min(key, key[::-1])
+
+    def wildcard_keys(kind, key):
+        if kind == 'dihedrals':
+            return [('X', key[1], key[2], 'X')]
+        elif kind == 'impropers':
+            return [(key[0], 'X', 'X', key[3]), ('X', key[1], key[2], key[3])]
+        return []
+
+    class ParameterIndex:
+        """Hash index over the bonded parameters of a CharmmPrmFile.
+
+        Keys are stored in a canonical orientation, and keys containing
+        the CHARMM wildcard 'X' go to a separate fallback table, so every
+        lookup is at most a few dict probes instead of a scan.
+        """
+
+        def __init__(self, prm):
+            self.exact = {}
+            self.wild = {}
+            for kind, w in PRM_KINDS:
+                exact = self.exact[kind] = {}
+                wild = self.wild[kind] = {}
+                for key in getattr(prm, kind, None) or ():
+                    key = tuple(key)
+                    table = wild if 'X' in key else exact
+                    table.setdefault(canonical_key(kind, key), key)
+
+        def lookup(self, kind, types):
+            """The key of the parameter table entry for types, or None."""
+            types = tuple(types)
+            key = self.exact[kind].get(canonical_key(kind, types))
+            if key is not None:
+                return key
+            wild = self.wild[kind]
+            for k in wildcard_keys(kind, types):
+                key = wild.get(canonical_key(kind, k))
+                if key is not None:
+                    return key
+            return None
+
+        def resolve(self, kind, codes, strings):
+            """Resolve rows of type codes, looking up each distinct row once.
+
+            Returns the parameter keys of the distinct rows (None where
+            missing), the distinct type tuples and the row-to-distinct map.
+            """
+            if not len(codes):
+                return [], [], np.zeros(0, dtype=np.int64)
+            if kind != 'cmaps':
+                rev = codes[:, ::-1]
+                first = (codes != rev).argmax(axis=1)
+                rows = np.arange(len(codes))
+                flip = rev[rows, first] < codes[rows, first]
+                codes = np.where(flip[:, None], rev, codes)
+            inverse = row_keys(*codes.T)
+            uniq = np.zeros(inverse.max() + 1, dtype=np.int64)
+            uniq[inverse] = np.arange(len(codes))
+            types = [tuple(strings[c] for c in row)
+                     for row in codes[uniq].tolist()]
+            return [self.lookup(kind, t) for t in types], types, inverse
+
+    _PRM_INDEX = {}
+
+    def parameter_index(prm):
+        """The ParameterIndex of prm, built once per parameter set."""
+        entry = _PRM_INDEX.get(id(prm))
+        if entry is None or entry[0] is not prm:
+            _PRM_INDEX.clear()
+            entry = _PRM_INDEX[id(prm)] = (prm, ParameterIndex(prm))
+        return entry[1]
+
+    def resolve_model_terms(mod, prm):
+        """Resolve every bonded term of mod against prm by its atom types.
+
+        Returns {kind: (keys, types, inverse)} as ParameterIndex.resolve.
+        """
+        cols = as_columns(mod)
+        mod = as_model(mod)
+        index = parameter_index(prm)
+        return dict((kind, index.resolve(kind,
+                                         cols.types[get_terms(mod, kind, w)],
+                                         cols.strings))
+                    for kind, w in PRM_KINDS)
+
+    class IndexedTable(dict):
+        """Parameter table that also finds reversed and wildcard keys.
+
+        resolved maps type tuples already looked up, such as those of
+        resolve_model_terms, to their keys so the writer's lookups of the
+        model's own terms are single dict probes.
+        """
+
+        def __init__(self, table, index, kind, resolved=None):
+            dict.__init__(self, table)
+            self.index = index
+            self.kind = kind
+            self.resolved = resolved or {}
+
+        def __missing__(self, key):
+            found = self.resolved.get(tuple(key))
+            if found is None:
+                found = self.index.lookup(self.kind, key)
+            if found is None:
+                raise KeyError(key)
+            return dict.__getitem__(self, found)
+
+        def __contains__(self, key):
+            return (dict.__contains__(self, key) or
+                    self.resolved.get(tuple(key)) is not None or
+                    self.index.lookup(self.kind, key) is not None)
+
+        def get(self, key, default=None):
+            try:
+                return self[key]
+            except KeyError:
+                return default
+
+    class IndexedParameters:
+        """CharmmPrmFile stand-in with IndexedTable parameter tables,
+        seeded with the keys of terms (see resolve_model_terms)."""
+
+        def __init__(self, prm, terms=None):
+            self.prm = prm
+            index = parameter_index(prm)
+            for kind, w in PRM_KINDS:
+                table = getattr(prm, kind, None)
+                if not isinstance(table, dict):
+                    continue
+                resolved = {}
+                if terms:
+                    keys, types = terms[kind][:2]
+                    for t, key in zip(types, keys):
+                        resolved[t] = key
+                        if kind != 'cmaps':
+                            resolved[t[::-1]] = key
+                setattr(self, kind,
+                        IndexedTable(table, index, kind, resolved))
+
+        def __getattr__(self, name):
+            return getattr(self.prm, name)
+
+    # CHARMM parameter file sections by their first four letters
+    PRM_SECTIONS = {'ATOM': 'atoms', 'BOND': 'bonds', 'ANGL': 'angles',
+                    'THET': 'angles', 'DIHE': 'dihedrals', 'PHI': 'dihedrals',
+                    'IMPR': 'impropers', 'IMPH': 'impropers',
+                    'CMAP': 'cmaps', 'NONB': 'nonbonded', 'NBON': 'nonbonded',
+                    'NBFI': 'nbfix', 'HBON': 'hbond', 'END': None}
+
+    def used_parameters(mod, prm):
+        """Canonical type tuples of the parameters mod refers to, by
+        section, with the atom types used under 'nonbonded'."""
+        cols = as_columns(mod)
+        terms = resolve_model_terms(mod, prm)
+        used = dict((kind, set(canonical_key(kind, key)
+                               for key in terms[kind][0] if key is not None))
+                    for kind, w in PRM_KINDS)
+        types = cols.strings.decode(np.unique(cols.types))
+        used['nonbonded'] = set((t,) for t in types)
+        return used
+
+    def prune_prm(lines, used):
+        """Yield the lines of a CHARMM parameter file that define the
+        terms in used (see used_parameters), with section headers, titles
+        and everything outside the sections kept."""
+        types = set(t for t, in used['nonbonded'])
+        widths = dict(PRM_KINDS)
+        section = None
+        keep = True
+        cont = False
+        for line in lines:
+            text = line.split('!', 1)[0]
+            words = text.split()
+            if cont:
+                cont = text.rstrip().endswith('-')
+                yield line
+                continue
+            if words and words[0][:4].upper() in PRM_SECTIONS:
+                section = PRM_SECTIONS[words[0][:4].upper()]
+                cont = text.rstrip().endswith('-')
+                yield line
+                continue
+            if section is None or section == 'hbond' or not words:
+                if words or section is None or keep:
+                    yield line
+                continue
+            if section == 'cmaps' and not words[0][:1].isalpha():
+                pass
+            elif section == 'atoms':
+                keep = len(words) > 2 and words[2] in types
+            elif section == 'nonbonded':
+                keep = words[0] in types
+            elif section == 'nbfix':
+                keep = words[0] in types and words[1] in types
+            else:
+                key = tuple(words[:widths[section]])
+                keep = canonical_key(section, key) in used[section]
+            if keep:
+                yield line
+
+    def pruned_prm_path(topfile):
+        """The parameter file next to topfile, e.g. sys.psf -> sys.prm."""
+        root, zext = os.path.splitext(topfile)
+        if get_compressor(topfile) is None:
+            root, zext = topfile, ''
+        return os.path.splitext(root)[0] + '.prm' + zext
+
+    def write_pruned_prm(mod, prm, parfile, fname):
+        """Write the parameters of parfile that mod uses to fname."""
+        t0 = time.time()
+        used = used_parameters(mod, prm)
+        f = input_file(parfile)
+        if f is parfile:
+            f = open(parfile)
+        with f:
+            lines = list(prune_prm(f, used))
+        with output_file(fname) as out:
+            if out is fname:
+                out = open(fname, 'w')
+            with out:
+                out.writelines(lines)
+        print('Wrote %s with %s in %.2f s' %
+              (fname, ', '.join('%d %s' % (len(used[kind]), kind)
+                                for kind in sorted(used)),
+               time.time() - t0))
+
+    def template_types(res):
+        """Atom name to atom type of a residue template."""
+        types = {}
+        for a in getattr(res, 'atoms', None) or ():
+            if hasattr(a, 'name'):
+                types[a.name] = a.type
+            else:
+                types[a[0]] = a[1]
+        return types
+
+    def template_terms(res):
+        """Bonded terms of a residue template as tuples of atom names.
+
+        Angles and dihedrals are generated from the bonds the way the
+        topology builder does; terms reaching into the neighbouring
+        residues ('-' or '+' atoms) are left out.
+        """
+        bonds = [tuple(b) for b in getattr(res, 'bonds', None) or ()
+                 if not any(n[0] in '-+' for n in b)]
+        nbrs = {}
+        for a, b in bonds:
+            nbrs.setdefault(a, []).append(b)
+            nbrs.setdefault(b, []).append(a)
+        angles = [(a, b, c) for b in nbrs for a in nbrs[b] for c in nbrs[b]
+                  if a < c]
+        dihedrals = [(a, b, c, d) for b, c in bonds
+                     for a in nbrs[b] if a != c
+                     for d in nbrs[c] if d != b and d != a]
+        terms = {'bonds': bonds, 'angles': angles, 'dihedrals': dihedrals}
+        for kind in ('impropers', 'cmaps'):
+            terms[kind] = [tuple(t) for t in getattr(res, kind, None) or ()
+                           if not any(n[0] in '-+' for n in t)]
+        return terms
+
+    def preflight(cols, top, prm, patches=()):
+        """List the problems building and writing cols would run into.
+
+        Every distinct residue name is checked against the topology, its
+        atom names against the residue template and the atom types of the
+        template terms against the parameters through the ParameterIndex,
+        so the cost grows with the number of distinct residues rather
+        than atoms.
+        """
+        problems = []
+        residues = getattr(top, 'residues', None) or {}
+        known_patches = getattr(top, 'patches', None) or {}
+        index = parameter_index(prm)
+        nonbonded = getattr(prm, 'nonbonded', None)
+        decode = cols.strings.decode
+
+        # 1 for atoms of the first polymer residue of a segment, 2 of the
+        # last, see chain_termini
+        nterm, cterm = chain_termini(cols)
+        role = nterm * 1 + cterm * 2
+
+        pairs = row_keys(cols.resnames, cols.names, role)
+        first = np.zeros(pairs.max() + 1 if len(pairs) else 0, dtype=int)
+        first[pairs] = np.arange(len(pairs))
+        atomnames = {}
+        for resname, name, r in zip(decode(cols.resnames[first]),
+                                    decode(cols.names[first]),
+                                    role[first].tolist()):
+            atomnames.setdefault(resname, []).append((name, r))
+
+        missing = {}
+        for resname in sorted(atomnames):
+            res = residues.get(resname)
+            if res is None:
+                problems.append('Residue %s is not in the topology file' %
+                                resname)
+                continue
+            types = template_types(res)
+            # atoms the default terminal patches add
+            added = [set(), set()]
+            for i, p in enumerate((getattr(res, 'first', None),
+                                   getattr(res, 'last', None))):
+                if p in known_patches:
+                    added[i] = set(template_types(known_patches[p]))
+            unknown = sorted(set(
+                    name for name, r in atomnames[resname]
+                    if name not in types and
+                    not (r & 1 and name in added[0]) and
+                    not (r & 2 and name in added[1])))
+            if unknown:
+                problems.append('Residue %s has no atoms %s' %
+                                (resname, ' '.join(unknown)))
+            for p in (getattr(res, 'first', None),
+                      getattr(res, 'last', None)):
+                if p and p.upper() != 'NONE' and p not in known_patches:
+                    problems.append('Patch %s of residue %s is not in the '
+                                    'topology file' % (p, resname))
+            if nonbonded is not None:
+                for t in sorted(set(types.values()) - set(nonbonded)):
+                    missing.setdefault(('nonbonded', (t,)), set()).add(
+                            resname)
+            for kind, terms in template_terms(res).items():
+                for names in terms:
+                    if not all(n in types for n in names):
+                        continue
+                    key = tuple(types[n] for n in names)
+                    if index.lookup(kind, key) is None:
+                        missing.setdefault((kind, key), set()).add(resname)
+        for p in patches:
+            if p not in known_patches:
+                problems.append('Patch %s is not in the topology file' % p)
+        for (kind, key), resnames in sorted(missing.items()):
+            problems.append('No %s parameters for %s (%s)' %
+                            (kind, ' '.join(key),
+                             ' '.join(sorted(resnames))))
+        return problems
+
+    def seed_rngs(seed):
+        random.seed(seed)
+        np.random.seed(seed)
+
+    def min_separation(mod, resnames):
+        """Smallest distance between atoms of the given residue names."""
+        idx = [i for i, a in enumerate(mod.atoms)
+               if getattr(a, 'resname', None) in resnames]
+        xyz = np.asarray(mod.coords)[idx]
+        best = np.inf
+        for i in range(len(xyz) - 1):
+            best = min(best, ((xyz[i + 1:] - xyz[i])**2).sum(axis=1).min())
+        return np.sqrt(best)
+
+    _ion_trials = {}
+
+    def _init_ion_trials(mod, args):
+        _ion_trials['mod'] = mod
+        _ion_trials['args'] = args
+
+    def _ion_trial(seed):
+        """(seed, minimum ion separation, None), or (seed, None, the
+        traceback) for a trial that failed."""
+        args = _ion_trials['args']
+        try:
+            with child_output():
+                seed_rngs(seed)
+                mod = add_ions(_ion_trials['mod'], *args)
+            return seed, min_separation(mod, (args[0], args[2])), None
+        except Exception:
+            return seed, None, traceback.format_exc()
+
+    def add_ions_seeded(mod, seed, ntrials, *args):
+        """add_ions() by random placement from a reproducible seed.
+
+        With several trials, trial i uses seed + i and runs in a worker
+        process.  The trial with the largest minimum ion-ion separation
+        is rerun here from its seed, so the result is reproducible from
+        the seed printed to the console.
+        """
+        mod = as_model(mod)
+        seeds = [seed + i for i in range(ntrials)]
+        if ntrials > 1:
+            _init_ion_trials(mod, args)
+            if os.name == 'posix':
+                pool = make_pool(initializer=_init_ion_trials,
+                                 initargs=(mod, args))
+                try:
+                    results = pool.map(_ion_trial, seeds)
+                finally:
+                    pool.terminate()
+            else:
+                # the RNGs are global, so threads cannot run trials
+                results = [_ion_trial(s) for s in seeds]
+            errors = []
+            for s, sep, tb in results:
+                if sep is None:
+                    error = tb.strip().splitlines()[-1]
+                    print('Trial with seed %d failed: %s' % (s, error))
+                    errors.append((tb, error))
+                else:
+                    print('Trial with seed %d: min ion separation %.2f A' %
+                          (s, sep))
+            results = [r for r in results if r[1] is not None]
+            if not results:
+                print(errors[0][0])
+                raise RuntimeError('all %d placement trials failed, the '
+                                   'first with %s' % (ntrials, errors[0][1]))
+            seed = max(results, key=lambda r: r[1])[0]
+        print('Placing ions with seed %d' % seed)
+        seed_rngs(seed)
+        return add_ions(mod, *args)
+
+    def hmr_masses(cols, bonds, hmass):
+        """Masses with every hydrogen raised to hmass, taking the mass
+        from the heavy atom it is bonded to. Water is left untouched."""
+        masses = cols.masses.copy()
+        hydrogen = (masses > 0.5) & (masses < 1.5)
+        hydrogen &= ~residue_mask(cols, WATERS)
+        if not len(bonds):
+            return masses
+        h0 = hydrogen[bonds[:, 0]]
+        h1 = hydrogen[bonds[:, 1]]
+        pairs = bonds[h0 != h1]
+        hyd = np.where(h0[h0 != h1], pairs[:, 0], pairs[:, 1])
+        heavy = np.where(h0[h0 != h1], pairs[:, 1], pairs[:, 0])
+        masses -= np.bincount(heavy, weights=hmass - masses[hyd],
+                              minlength=len(masses))
+        masses[hyd] = hmass
+        if (masses[heavy] <= 0).any():
+            raise ValueError('hydrogen mass %g leaves heavy atoms without '
+                             'mass' % hmass)
+        return masses
+
+    @contextmanager
+    def repartitioned_masses(mod, cols, hmass):
+        """Set the atom masses of mod to hmr_masses() while writing."""
+        if not hmass:
+            yield
+            return
+        old = cols.masses
+        new = hmr_masses(cols, get_terms(mod, 'bonds', 2), hmass)
+        changed = np.flatnonzero(new != old).tolist()
+        print('Repartitioned the masses of %d atoms' % len(changed))
+        atoms = mod.atoms
+        try:
+            for i, m in zip(changed, new[changed].tolist()):
+                atoms[i].mass = m
+            yield
+        finally:
+            for i, m in zip(changed, old[changed].tolist()):
+                atoms[i].mass = m
+
+    class VirtualSites:
+        """Massless sites of a 4- or 5-point water model, kept as one
+        block of arrays beside the atoms.
+
+        frames holds the O, H1, H2 atom indices of every water and index
+        the atom index of each of its sites, or -1 for sites the model
+        does not hold yet.
+        """
+
+        def __init__(self, water, frames, index):
+            self.water = water
+            self.host_charges, sites = WATER_SITES[water]
+            self.names = [site[0] for site in sites]
+            self.charges, self.a, self.b, self.c = \
+                np.array([site[1:] for site in sites]).T
+            self.frames = frames
+            self.index = index
+
+        def __len__(self):
+            return self.index.size
+
+        def positions(self, coords):
+            """Site coordinates (waters x sites x 3) for all waters."""
+            o, h1, h2 = (coords[self.frames[:, k]] for k in range(3))
+            r1 = h1 - o
+            r2 = h2 - o
+            return (o[:, None] + self.a[:, None] * r1[:, None] +
+                    self.b[:, None] * r2[:, None] +
+                    self.c[:, None] * np.cross(r1, r2)[:, None])
+
+    def water_sites(cols, water):
+        """VirtualSites of every complete water of cols."""
+        names = WATER_SITES[water][1]
+        roles = np.full(len(cols.strings), -1, dtype=np.int64)
+        index = cols.strings.index
+        for role, alias in enumerate((('OH2', 'OW', 'O'), ('H1', 'HW1'),
+                                      ('H2', 'HW2')) +
+                                     tuple((site[0],) for site in names)):
+            roles[[index[a] for a in alias if a in index]] = role
+        atoms = np.flatnonzero(residue_mask(cols, WATERS))
+        role = roles[cols.names[atoms]]
+        atoms, role = atoms[role >= 0], role[role >= 0]
+        res = np.unique(residue_ordinals(cols)[atoms],
+                        return_inverse=True)[1].reshape(-1)
+        table = np.full((res.max() + 1 if len(res) else 0,
+                         3 + len(names)), -1, dtype=np.int64)
+        table[res, role] = atoms
+        table = table[(table[:, :3] >= 0).all(axis=1)]
+        return VirtualSites(water, table[:, :3], table[:, 3:])
+
+    def site_types(top, water):
+        """Atom types of the sites of water, from the water residue of the
+        topology that has all of them."""
+        names = [site[0] for site in WATER_SITES[water][1]]
+        residues = getattr(top, 'residues', None) or {}
+        for resname in WATERS:
+            types = template_types(residues.get(resname))
+            if all(name in types for name in names):
+                return [types[name] for name in names]
+        raise ValueError('No water residue with the %s sites %s in the '
+                         'topology' % (water, ', '.join(names)))
+
+    @contextmanager
+    def virtual_site_model(mod, cols, water, top):
+        """Yield mod with the sites of water placed, adding them after
+        the last atom of their water where they are missing.
+
+        Site positions are computed for all waters at once; the new atoms
+        are copies of the oxygens typed from the water residue of top, and
+        the O and H charges are those of the model while writing.
+        """
+        if water not in WATER_SITES:
+            yield mod
+            return
+        sites = water_sites(cols, water)
+        if not len(sites):
+            yield mod
+            return
+        t0 = time.time()
+        coords = np.asarray(mod.coords)
+        xyz = sites.positions(coords)
+        missing = (sites.index < 0).all(axis=1)
+        hosts = sites.frames.ravel().tolist()
+        old = [mod.atoms[i].charge for i in hosts]
+        have = sites.index >= 0
+        if missing.any():
+            types = site_types(top, water)
+            n = len(mod.atoms)
+            last = sites.frames[missing].max(axis=1)
+            m = len(sites.names)
+            added = np.zeros(n, dtype=np.int64)
+            added[last] = m
+            newpos = np.arange(n) + np.cumsum(added) - added
+            sitepos = (newpos[last][:, None] + 1 + np.arange(m)).ravel()
+            new = empty_like(mod)
+            new.coords = np.empty((n + len(sitepos), 3))
+            new.coords[newpos] = coords
+            new.coords[sitepos] = xyz[missing].reshape(-1, 3)
+            src = np.empty(len(new.coords), dtype=np.int64)
+            src[newpos] = np.arange(n)
+            src[sitepos] = -1 - np.arange(len(sitepos))
+            extra = []
+            for o in sites.frames[missing, 0].tolist():
+                for name, typ, q in zip(sites.names, types,
+                                        sites.charges.tolist()):
+                    a = copy.copy(mod.atoms[o])
+                    a.name = name
+                    a.type = typ
+                    a.charge = q
+                    a.mass = 0.0
+                    extra.append(a)
+            atoms = mod.atoms
+            new.atoms = [atoms[i] if i >= 0 else extra[-1 - i]
+                         for i in src.tolist()]
+            for attr, w in TERMS:
+                if hasattr(mod, attr):
+                    setattr(new, attr, list(map(
+                            tuple, newpos[get_terms(mod, attr, w)].tolist())))
+            frames = newpos[sites.frames]
+            index = sites.index.copy()
+            index[have] = newpos[index[have]]
+            index[missing] = sitepos.reshape(-1, m)
+            new.vsites = VirtualSites(water, frames, index)
+            new.coords[newpos[sites.index[have]]] = xyz[have]
         else:
-            raise ValueError('Unsupported coordinate format' % crdfmt)
+            new = mod
+            new.coords = coords.copy()
+            new.coords[sites.index[have]] = xyz[have]
+            new.vsites = sites
+        print('Placed %d %s sites (%d added) in %.2f s' %
+              (len(sites), water, int(missing.sum()) * len(sites.names),
+               time.time() - t0))
+        charges = np.tile(np.repeat(sites.host_charges, (1, 2)),
+                          len(sites.frames)).tolist()
+        try:
+            for i, q in zip(hosts, charges):
+                mod.atoms[i].charge = q
+            yield new
+        finally:
+            for i, q in zip(hosts, old):
+                mod.atoms[i].charge = q
+            if new is mod:
+                mod.coords = coords
+                del mod.vsites
+
+    def save_files(mod, prm, topfmt, topfile, crdfmt, crdfile, ffinfo,
+                   ensemble=None, hmass=None, water=None, parfile=None,
+                   top=None):
+        cols = None
+        if hmass or water in WATER_SITES:
+            cols = as_columns(mod)
+        mod = as_model(mod)
+        with repartitioned_masses(mod, cols, hmass):
+            with virtual_site_model(mod, cols, water, top) as mod:
+                return write_files(mod, prm, topfmt, topfile, crdfmt,
+                                   crdfile, ffinfo, ensemble, parfile)
+
+    def write_files(mod, prm, topfmt, topfile, crdfmt, crdfile, ffinfo,
+                    ensemble=None, parfile=None):
+        nfiles = 0
+        if parfile and topfmt == 'NAMD psf':
+            write_pruned_prm(mod, prm, parfile, pruned_prm_path(topfile))
+            nfiles = 1
+        if topfmt in ('AMBER prmtop', 'CHAMBER prmtop'):
+            terms = resolve_model_terms(mod, prm)
+            for kind, w in PRM_KINDS:
+                keys = terms[kind][0]
+                if keys:
+                    print('%d %s, %d distinct types, %d without parameters' %
+                          (len(terms[kind][2]), kind, len(keys),
+                           keys.count(None)))
+            prm = IndexedParameters(prm, terms)
+        with output_file(topfile) as f:
+            if topfmt == 'NAMD psf':
+                PsfFile(f, 'w').write(mod)
+            elif topfmt == 'AMBER prmtop':
+                PrmtopFile(f, 'w').write(mod, prm, 1, None, chamber=False)
+            elif topfmt == 'CHAMBER prmtop':
+                PrmtopFile(f, 'w').write(mod, prm, 1, ffinfo, chamber=True)
+            elif topfmt == 'GROMACS top':
+                GromacsTopFile(f, 'w').write(mod, ffinfo)
+            else:
+                raise ValueError('Unsupported topology format' % topfmt)
+
+        if not ensemble:
+            write_coords(mod, crdfmt, crdfile)
+            return nfiles + 2
+
+        coords = np.array(mod.coords)
+        try:
+            for i, xyz in enumerate(ensemble):
+                mod.coords[:] = xyz
+                write_coords(mod, crdfmt, model_path(crdfile, i + 1))
+        finally:
+            mod.coords[:] = coords
+        return nfiles + 1 + len(ensemble)
+
+    def model_path(fname, i):
+        """Number a file name by model, e.g. sys.gro.gz -> sys_02.gro.gz."""
+        root, zext = os.path.splitext(fname)
+        if get_compressor(fname) is None:
+            root, zext = fname, ''
+        root, ext = os.path.splitext(root)
+        return '%s_%02d%s%s' % (root, i, ext, zext)
+
+    def write_coords(mod, crdfmt, crdfile):
+        with output_file(crdfile) as f:
+            if crdfmt == 'pdb':
+                PdbFile(f, 'w').write(mod)
+            elif crdfmt == 'NAMD bin':
+                NamdBinFile(f, 'w').write(mod.coords)
+            elif crdfmt == 'AMBER inpcrd':
+                AmberTxtRstFile(f, 'w').write(mod.coords)
+            elif crdfmt == 'GROMACS g96':
+                G96File(f, 'w').write(mod)
+            elif crdfmt == 'GROMACS gro':
+                GroFile(f, 'w').write(mod)
+            else:
+                raise ValueError('Unsupported coordinate format' % crdfmt)
+
+    # functions the worker may run: stages replace its model, calls don't
+    WORKER_STAGES = {'add_solvents': add_solvents,
+                     'add_cosolvents': add_cosolvents,
+                     'add_ions': add_ions,
+                     'add_ions_seeded': add_ions_seeded}
+    WORKER_CALLS = {'save_files': save_files}
+
+    class StageError(Exception):
+        """A stage failed in the worker process."""
+
+        def __init__(self, name, message, tb):
+            Exception.__init__(self, '%s: %s' % (name, message))
+            self.tb = tb
+
+    def share_columns(cols, path):
+        """Write the columns of cols to the file path, which is mapped
+        in memory by both processes. Returns what mapped_columns needs."""
+        layout = []
+        offset = 0
+        for attr in cols.COLUMNS:
+            a = getattr(cols, attr)
+            layout.append((attr, a.dtype.str, a.shape, offset))
+            offset += a.nbytes
+        buf = np.memmap(path, dtype=np.uint8, mode='w+',
+                        shape=(max(offset, 1),))
+        for attr, dtype, shape, offset in layout:
+            a = np.ascontiguousarray(getattr(cols, attr))
+            buf[offset:offset + a.nbytes] = a.reshape(-1).view(np.uint8)
+        buf.flush()
+        del buf
+        return layout, cols.strings.strings, cols.box
+
+    def mapped_columns(path, layout, strings, box):
+        buf = np.memmap(path, dtype=np.uint8, mode='r')
+        cols = ColumnarModel(0, StringTable(strings))
+        for attr, dtype, shape, offset in layout:
+            n = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            setattr(cols, attr, np.array(
+                    buf[offset:offset + n].view(dtype).reshape(shape)))
+        del buf
+        cols.box = box
+        return cols
+
+    class PipeWriter:
+        """stdout of the worker process: complete lines are sent to the
+        parent as ('log', text) messages for it to print."""
+
+        def __init__(self, conn):
+            self.conn = conn
+            self.buf = ''
+
+        def write(self, s):
+            self.buf += s
+            if '\n' in self.buf:
+                text, self.buf = self.buf.rsplit('\n', 1)
+                self.conn.send(('log', text + '\n'))
+
+        def flush(self):
+            if self.buf:
+                self.conn.send(('log', self.buf))
+                self.buf = ''
+
+    def _stage_worker(conn, path):
+        # the forked worker must not write to the GUI console itself
+        sys.stdout = PipeWriter(conn)
+        sys.stderr = sys.__stderr__
+        cols = None
+        while True:
+            try:
+                msg = conn.recv()
+            except EOFError:
+                break
+            if msg[0] == 'quit':
+                break
+            try:
+                if msg[0] == 'load':
+                    cols = as_columns(msg[1])
+                    result = None
+                elif msg[0] == 'run':
+                    mod = WORKER_STAGES[msg[1]](cols, *msg[2])
+                    cols = as_columns(mod)
+                    result = share_columns(cols, path)
+                else:
+                    result = WORKER_CALLS[msg[1]](cols, *msg[2])
+                sys.stdout.flush()
+                conn.send(('ok', result))
+            except Exception as e:
+                sys.stdout.flush()
+                conn.send(('error', type(e).__name__, str(e),
+                           traceback.format_exc()))
+        conn.close()
+
+    def shm_dir():
+        if os.path.isdir('/dev/shm'):
+            return '/dev/shm'
+        return None
+
+    class StageWorker:
+        """Persistent process running the stages on its own model.
+
+        The model is sent once with load(); after that only stage names
+        and arguments go to the worker, and the resulting columns come
+        back through a memory-mapped file rather than a pickle. The
+        worker replaces its model only when a stage succeeds, and errors
+        are raised here as StageError with the worker's traceback. While
+        waiting, wait() is called so the caller can keep the GUI alive.
+        """
+
+        def __init__(self):
+            fd, self.path = tempfile.mkstemp(prefix='emdy-', dir=shm_dir())
+            os.close(fd)
+            self.conn, child = multiprocessing.Pipe()
+            self.process = multiprocessing.Process(
+                    target=_stage_worker, args=(child, self.path))
+            self.process.start()
+            child.close()
+            atexit.register(self.close)
+
+        def request(self, msg, wait=None):
+            self.conn.send(msg)
+            while True:
+                while not self.conn.poll(0.05):
+                    if not self.process.is_alive():
+                        raise StageError('WorkerError',
+                                         'the worker process exited', '')
+                    if wait is not None:
+                        wait()
+                reply = self.conn.recv()
+                if reply[0] != 'log':
+                    break
+                # output of the worker goes to the console here
+                sys.stdout.write(reply[1])
+            if reply[0] == 'error':
+                raise StageError(*reply[1:])
+            return reply[1]
+
+        def load(self, mod, wait=None):
+            self.request(('load', as_model(mod)), wait)
+
+        def run(self, name, args, wait=None):
+            """Run a stage, returning the new columns."""
+            return mapped_columns(self.path,
+                                  *self.request(('run', name, args), wait))
+
+        def call(self, name, args, wait=None):
+            return self.request(('call', name, args), wait)
+
+        def close(self):
+            if self.process.is_alive():
+                try:
+                    self.conn.send(('quit',))
+                except (IOError, OSError):
+                    pass
+                self.process.join(1)
+                if self.process.is_alive():
+                    self.process.terminate()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def get_compressor(fname):
+    ext = os.path.splitext(fname)[1].lower()
+    if ext == '.gz':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif ext == '.bz2':
+        return bz2.BZ2Compressor()
+    elif ext == '.xz':
+        if lzma is None:
+            raise ImportError('lzma is needed to write %s' % fname)
+        return lzma.LZMACompressor()
+    return None
+
+
+def compressed_exts():
+    exts = ['.gz', '.bz2']
+    if lzma is not None:
+        exts.append('.xz')
+    return exts
+
+
+class CompressedWriter:
+    """Write-only file object that compresses on a background thread.
+
+    Formatted text is handed over in 1 MB chunks, so the writer formats
+    the next chunk while the previous one is being compressed.
+    """
+
+    chunksize = 1 << 20
+
+    def __init__(self, fname, compressor):
+        self.name = fname
+        self.fp = open(fname, 'wb')
+        self.compressor = compressor
+        self.buf = []
+        self.size = 0
+        self.error = None
+        self.closed = False
+        self.queue = Queue.Queue(maxsize=4)
+        self.thread = threading.Thread(target=self.compress)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def compress(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error is None:
+                try:
+                    self.fp.write(self.compressor.compress(data))
+                except Exception as e:
+                    self.error = e
+        try:
+            if self.error is None:
+                self.fp.write(self.compressor.flush())
+        except Exception as e:
+            self.error = e
+        finally:
+            self.fp.close()
+
+    def write(self, s):
+        self.buf.append(s)
+        self.size += len(s)
+        if self.size >= self.chunksize:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self.buf:
+            self.queue.put(''.join(self.buf))
+            self.buf = []
+            self.size = 0
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@contextmanager
+def output_file(fname):
+    """Yield fname itself, or a CompressedWriter for .gz/.bz2/.xz names."""
+    compressor = get_compressor(fname)
+    if compressor is None:
+        yield fname
+    else:
+        f = CompressedWriter(fname, compressor)
+        try:
+            yield f
+        finally:
+            f.close()
+
+
+def input_file(fname):
+    """Return fname itself, or a decompressing file object."""
+    ext = os.path.splitext(fname)[1].lower()
+    if ext == '.gz':
+        return gzip.open(fname, 'rb')
+    elif ext == '.bz2':
+        return bz2.BZ2File(fname, 'rb')
+    elif ext == '.xz':
+        if lzma is None:
+            raise ImportError('lzma is needed to read %s' % fname)
+        return lzma.open(fname, 'rb')
+    return fname
 
 
 def draw_axes():